@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import yaml
+import shutil
+import subprocess
+import fake_cluster
+from getopt import getopt
+from tempfile import mkdtemp
+
+def print_message(s):
+    print(s, file = sys.stderr)
+
+def die(s):
+    print(s, file = sys.stderr)
+    sys.exit(2)
+
+def usage():
+    die('''     %s [-s 10,100,1000] [-l latency] [-S startup-delay] [-f failure-rate] [-F pod-failure-rate] [-I iri-failure-rate] [-p parallelism] [-D] [-o results.json] [-b baseline.json]
+
+                # -s / --sizes              Comma separated numbers of nodes of the synthetic clusters, defaults to 10,100,1000
+                # -l / --latency            Seconds of latency added to every fake API call, defaults to 0
+                # -S / --startup-delay      Mean seconds for a fake pod to become ready, defaults to 1
+                # -f / --failure-rate       Fraction of Kubernetes API calls failing with a 500 or 429 error, defaults to 0
+                # -F / --pod-failure-rate   Fraction of pods failing on startup, defaults to 0
+                # -I / --iri-failure-rate   Fraction of IRI API calls failing with a 500 error, defaults to 0
+                # -p / --parallelism        Parallelism passed to create_cluster.py and teardown_cluster.py, defaults to 10
+                # -D / --db-cache           Give every node a database, served by the shared DB cache
+                # -o / --output             output file for the results in JSON format
+                # -b / --baseline           results of a previous run in JSON format to compare against
+        ''' % __file__)
+
+def parse_opts(opts):
+    global sizes, latency, startup_delay, failure_rate, pod_failure_rate, iri_failure_rate, parallelism, db_cache, output, baseline
+    for (key, value) in opts:
+        if key == '-s' or key == '--sizes':
+            sizes = [ int(size) for size in value.split(',') ]
+        elif key == '-l' or key == '--latency':
+            latency = float(value)
+        elif key == '-S' or key == '--startup-delay':
+            startup_delay = float(value)
+        elif key == '-f' or key == '--failure-rate':
+            failure_rate = float(value)
+        elif key == '-F' or key == '--pod-failure-rate':
+            pod_failure_rate = float(value)
+        elif key == '-I' or key == '--iri-failure-rate':
+            iri_failure_rate = float(value)
+        elif key == '-p' or key == '--parallelism':
+            parallelism = int(value)
+        elif key == '-D' or key == '--db-cache':
+            db_cache = True
+        elif key == '-o' or key == '--output':
+            output = value
+        elif key == '-b' or key == '--baseline':
+            baseline = value
+        else:
+            usage()
+    if not sizes or min(sizes) < 1 or parallelism < 1:
+        usage()
+
+def synthetic_cluster(size):
+    # Every node is wired to the previous and the next one on a ring
+    cluster = { 'monitoring': False, 'nodes': {} }
+    if db_cache:
+        cluster['db_cache'] = True
+    for index in range(0, size):
+        neighbors = sorted(set((index + offset) % size for offset in [ 1, size - 1 ]) - set([ index ]))
+        node = { 'neighbors': [ 'udp://node%d:14600' % neighbor for neighbor in neighbors ] }
+        if db_cache:
+            node['db'] = 'https://example.com/testnet_files.tgz'
+            node['db_checksum'] = '6eaa06d5442416b7b8139e337a1598d2bae6a7f55c2d9d01f8c5dac69c004f75'
+        cluster['nodes']['node%d' % index] = node
+    return cluster
+
+def run(command, log_path):
+    # Peak memory is read from the resource usage of the child itself, so that the fake APIs served
+    # by this process are not accounted for
+    with open(log_path, 'w') as log:
+        started = time.time()
+        process = subprocess.Popen(command, stdout = log, stderr = subprocess.STDOUT)
+        (_, status, resources) = os.wait4(process.pid, 0)
+        elapsed = time.time() - started
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    peak_memory = resources.ru_maxrss / 1024.0 / (1024.0 if sys.platform == 'darwin' else 1.0)
+    return (process.returncode, elapsed, peak_memory)
+
+def calls_delta(before, after):
+    return { key: count - before.get(key, 0) for (key, count) in after.items() if count != before.get(key, 0) }
+
+def tail(path, lines = 20):
+    with open(path, 'r') as stream:
+        return ''.join(stream.readlines()[-lines:])
+
+def benchmark(size):
+    tag = 'benchmark-%d' % size
+    cluster_path = os.path.join(workdir, '%s.yml' % tag)
+    output_path = os.path.join(workdir, '%s-output.yml' % tag)
+    with open(cluster_path, 'w') as stream:
+        stream.write(yaml.dump(synthetic_cluster(size), default_flow_style = False))
+
+    result = { 'nodes': size }
+    (kubernetes_calls, iri_calls) = (fake_kubernetes.call_counts(), fake_iri.call_counts())
+    print_message("Deploying %d nodes" % size)
+    (result['create_status'], result['create_seconds'], result['create_peak_memory_mb']) = run(
+        [ sys.executable, os.path.join(base_path, 'create_cluster.py'), '-i', 'iotaledger/iri:latest', '-t', tag,
+          '-c', cluster_path, '-o', output_path, '-k', kubeconfig, '-p', str(parallelism) ],
+        os.path.join(workdir, '%s-create.log' % tag))
+    result['create_kubernetes_calls'] = calls_delta(kubernetes_calls, fake_kubernetes.call_counts())
+    result['create_iri_calls'] = calls_delta(iri_calls, fake_iri.call_counts())
+    result['nodes_per_second'] = size / result['create_seconds']
+    # create_cluster.py exits with 2 when some nodes failed, which is expected with injected pod failures
+    if result['create_status'] not in [ 0, 2 ]:
+        print_message(tail(os.path.join(workdir, '%s-create.log' % tag)))
+    elif os.path.exists(output_path):
+        with open(output_path, 'r') as stream:
+            deployment = yaml.load(stream, Loader = yaml.SafeLoader)
+        result['phases_seconds'] = { name: timing['duration'] for (name, timing) in deployment.get('timings', {}).items() }
+        result['running_nodes'] = len([ node for node in deployment['nodes'].values() if node.get('status') == 'Running' ])
+
+    kubernetes_calls = fake_kubernetes.call_counts()
+    print_message("Tearing down %d nodes" % size)
+    (result['teardown_status'], result['teardown_seconds'], result['teardown_peak_memory_mb']) = run(
+        [ sys.executable, os.path.join(base_path, 'teardown_cluster.py'), '-t', tag, '-k', kubeconfig, '-p', str(parallelism), '-w' ],
+        os.path.join(workdir, '%s-teardown.log' % tag))
+    result['teardown_kubernetes_calls'] = calls_delta(kubernetes_calls, fake_kubernetes.call_counts())
+    if result['teardown_status'] != 0:
+        print_message(tail(os.path.join(workdir, '%s-teardown.log' % tag)))
+    return result
+
+def print_results(results, baseline_results):
+    baseline_sizes = { result['nodes']: result for result in baseline_results }
+    print('%8s %10s %8s %8s %8s %10s %10s %8s %8s' % ('nodes', 'create s', 'nodes/s', 'k8s', 'iri', 'peak MB', 'teardown s', 'k8s', 'status'))
+    for result in results:
+        print('%8d %10.2f %8.1f %8d %8d %10.1f %10.2f %8d %8s' % (
+            result['nodes'], result['create_seconds'], result['nodes_per_second'],
+            sum(result['create_kubernetes_calls'].values()), sum(result['create_iri_calls'].values()),
+            result['create_peak_memory_mb'], result['teardown_seconds'], sum(result['teardown_kubernetes_calls'].values()),
+            '%d/%d' % (result['create_status'], result['teardown_status'])))
+        previous = baseline_sizes.get(result['nodes'])
+        if previous:
+            print('%8s %+9.1f%% %+7.1f%% %+8d %+8d %+9.1f%% %+9.1f%%' % (
+                'vs base', 100.0 * (result['create_seconds'] / previous['create_seconds'] - 1),
+                100.0 * (result['nodes_per_second'] / previous['nodes_per_second'] - 1),
+                sum(result['create_kubernetes_calls'].values()) - sum(previous['create_kubernetes_calls'].values()),
+                sum(result['create_iri_calls'].values()) - sum(previous['create_iri_calls'].values()),
+                100.0 * (result['create_peak_memory_mb'] / previous['create_peak_memory_mb'] - 1),
+                100.0 * (result['teardown_seconds'] / previous['teardown_seconds'] - 1)))
+
+sizes = [ 10, 100, 1000 ]
+latency = 0
+startup_delay = 1
+failure_rate = 0
+pod_failure_rate = 0
+iri_failure_rate = 0
+parallelism = 10
+db_cache = False
+output = None
+baseline = None
+
+if __name__ == '__main__':
+    try:
+        opts = getopt(sys.argv[1:], 's:l:S:f:F:I:p:Do:b:', ['sizes=', 'latency=', 'startup-delay=', 'failure-rate=', 'pod-failure-rate=',
+                                                         'iri-failure-rate=', 'parallelism=', 'db-cache', 'output=', 'baseline='])
+        parse_opts(opts[0])
+    except:
+        usage()
+
+    baseline_results = []
+    if baseline is not None:
+        with open(baseline, 'r') as stream:
+            baseline_results = json.load(stream)['results']
+
+    base_path = os.path.dirname(os.path.realpath(__file__))
+    workdir = mkdtemp(prefix = 'tiab-benchmark-')
+    kubeconfig = os.path.join(workdir, 'kube.config')
+    (fake_kubernetes, fake_iri) = fake_cluster.start_fake_cluster(kubeconfig, latency = latency, startup_delay = startup_delay,
+                                                                  failure_rate = failure_rate, pod_failure_rate = pod_failure_rate,
+                                                                  iri_failure_rate = iri_failure_rate)
+    try:
+        results = [ benchmark(size) for size in sizes ]
+    finally:
+        shutil.rmtree(workdir, True)
+
+    print_results(results, baseline_results)
+    if output is not None:
+        with open(output, 'w') as stream:
+            json.dump({ 'parameters': { 'latency': latency, 'startup_delay': startup_delay, 'failure_rate': failure_rate,
+                                        'pod_failure_rate': pod_failure_rate, 'iri_failure_rate': iri_failure_rate,
+                                        'parallelism': parallelism, 'db_cache': db_cache },
+                        'results': results }, stream, indent = 2, sort_keys = True)
+    if any(result['create_status'] not in [ 0, 2 ] or result['teardown_status'] != 0 for result in results):
+        sys.exit(2)
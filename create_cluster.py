@@ -8,21 +8,58 @@ import yaml
 import os
 import sys
 import copy
+import gzip
 import time
+import atexit
+import threading
+import traceback
+import shutil
+import hashlib
+import random
 import tarfile
+import calendar
+import urllib3
 import requests
 import kubernetes
+import generate_topology
+from websocket import ABNF
 from uuid import uuid4
 from getopt import getopt
-from jinja2 import Template
-from tempfile import TemporaryFile
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from tempfile import mkdtemp
 from functools import reduce
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 api_headers = {
                 'X-IOTA-API-Version': '1',
                 'Content-Type': 'application/json'
               }
 
+# API server responses worth retrying: throttling and transient server-side failures
+retryable_statuses = [ 429, 500, 502, 503, 504 ]
+
+string_types = (str, type(u''))
+
+# Manifests a registry may answer for an image tag, multi-architecture lists first
+manifest_media_types = [ 'application/vnd.docker.distribution.manifest.list.v2+json',
+                         'application/vnd.oci.image.index.v1+json',
+                         'application/vnd.docker.distribution.manifest.v2+json',
+                         'application/vnd.oci.image.manifest.v1+json' ]
+
+bearer_challenge_regex = re.compile('([a-z]+)="([^"]*)"')
+
+neighbor_regex = re.compile('^([a-z]+?)://([^:]+?):(\d+)$')
+
+# Node names end up in the nodenum label of the pods, so they must be valid label values
+node_name_regex = re.compile('^([A-Za-z0-9][-A-Za-z0-9_.]{0,61})?[A-Za-z0-9]$')
+
+# Stand-ins for the per-resource template variables, replaced in the parsed base resource of each kind
+sentinel_regex = re.compile('tiab-sentinel-[a-z_]+')
+
+# Printed by tiab-entrypoint.sh around each of its steps
+timing_marker_regex = re.compile(r'^TIAB_TIMING (\S+) (start|end) ([0-9.]+)$', re.MULTILINE)
+
 def print_message(s):
     if debug:
         print('[+] %s' % str(s).rstrip())
@@ -31,16 +68,115 @@ def die(s):
     print(s, file = sys.stderr)
     sys.exit(2)
 
-def success(output, cluster):
-    output.write(yaml.dump(cluster, default_flow_style = False))
-    sys.exit(0)
+def epoch(value):
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6 if value is not None else None
 
-def fail(output, cluster):
-    output.write(yaml.dump(cluster, default_flow_style = False))
-    sys.exit(2)
+def record_timing(tag, track, name, start, end):
+    # Spans are kept with their absolute times, and reported relative to the start of the deployment
+    timings.append((tag, track, name, start, end))
+
+def start_phase(tag, name):
+    # The current phase is kept per tag, as the deployments of a batch go through their phases side by side
+    now = time.time()
+    (phase, phase_start) = phases.get(tag, (None, None))
+    if phase is not None:
+        record_timing(tag, 'deployment', phase, phase_start, now)
+    phases[tag] = (name, now)
+
+def pod_time_bounds(created_after):
+    # Pod times are kept between the request creating the pod and now: Kubernetes truncates them to the
+    # second, and the pod clock may differ from ours, which would otherwise put steps before the pod was created
+    now = time.time()
+    return lambda t: min(max(t, created_after), now) if t is not None else None
+
+def record_pod_timings(tag, track, pod, events, created_after):
+    # Kubernetes reports pod conditions and events with a one second resolution
+    bound = pod_time_bounds(created_after)
+    created = bound(epoch(pod.metadata.creation_timestamp))
+    conditions = { condition.type: bound(epoch(condition.last_transition_time)) for condition in pod.status.conditions or [] }
+    started = [ bound(epoch(status.state.running.started_at)) for status in pod.status.container_statuses or [] if status.state.running ]
+    if conditions.get('PodScheduled'):
+        record_timing(tag, track, 'scheduling', created, conditions['PodScheduled'])
+    pulling = [ bound(epoch(event.first_timestamp)) for event in events if event.reason == 'Pulling' and event.first_timestamp ]
+    pulled = [ bound(epoch(event.last_timestamp)) for event in events if event.reason == 'Pulled' and event.last_timestamp ]
+    if pulling and pulled:
+        record_timing(tag, track, 'image_pull', min(pulling), max(pulled))
+    if started and conditions.get('Ready'):
+        record_timing(tag, track, 'startup', max(started), conditions['Ready'])
+
+def record_log_timings(tag, track, log, created_after):
+    bound = pod_time_bounds(created_after)
+    starts = {}
+    for (name, edge, value) in timing_marker_regex.findall(log):
+        if edge == 'start':
+            starts[name] = bound(float(value))
+        elif name in starts:
+            record_timing(tag, track, name, starts.pop(name), bound(float(value)))
+
+def capture_pod_log(kubernetes_client, pod_name, path):
+    # The whole transfer counts as one API call, so that it is retried from scratch and holds its
+    # share of the API calls budget until the log is saved
+    return call_with_retries(stream_pod_log, kubernetes_client, pod_name, path)
+
+def stream_pod_log(kubernetes_client, pod_name, path):
+    # Streams the log of the IRI container of a pod to a file, gzipped if its name ends with .gz, only
+    # keeping its last lines and its timing markers in memory. The container has to be named, as pods
+    # with a tanglescope sidecar have two.
+    kwargs = { 'limit_bytes': log_limit_bytes } if log_limit_bytes else {}
+    response = kubernetes_client.read_namespaced_pod_log(pod_name, namespace, container = 'iri', _preload_content = False, **kwargs)
+    (tail, markers, pending, size) = (deque(maxlen = log_tail_lines), [], b'', 0)
+    try:
+        with (gzip.open if path.endswith('.gz') else open)(path, 'wb') as stream:
+            for chunk in response.stream(log_chunk_size):
+                stream.write(chunk)
+                size += len(chunk)
+                lines = (pending + chunk).split(b'\n')
+                pending = lines.pop()
+                tail.extend(lines)
+                markers += [ line for line in lines if b'TIAB_TIMING' in line ]
+    finally:
+        response.release_conn()
+    if pending:
+        tail.append(pending)
+        markers += [ pending ] if b'TIAB_TIMING' in pending else []
+    decode = lambda lines: '\n'.join(line.decode('utf-8', 'replace') for line in lines)
+    return (decode(tail), decode(markers), bool(log_limit_bytes) and size >= log_limit_bytes)
+
+def list_pods_events(kubernetes_client, pod_names):
+    pods_events = { pod_name: [] for pod_name in pod_names }
+    for event in call_with_retries(kubernetes_client.list_namespaced_event, namespace, field_selector = 'involvedObject.kind=Pod').items:
+        if event.involved_object.name in pods_events:
+            pods_events[event.involved_object.name].append(event)
+    return pods_events
+
+def timings_report(tag, track):
+    return { name: { 'start': round(start - deployment_start, 3), 'duration': round(end - start, 3) }
+             for (span_tag, span_track, name, start, end) in timings if span_tag == tag and span_track == track }
+
+def write_trace(path, tag, docker_image, tracks):
+    # Chrome trace event format, to be loaded in chrome://tracing or https://ui.perfetto.dev
+    events = []
+    for (tid, track) in enumerate(tracks):
+        events.append({ 'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': { 'name': track } })
+        events.append({ 'name': 'thread_sort_index', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': { 'sort_index': tid } })
+    tids = { track: tid for (tid, track) in enumerate(tracks) }
+    for (span_tag, track, name, start, end) in timings:
+        if span_tag == tag and track in tids:
+            events.append({ 'name': name, 'cat': 'tiab', 'ph': 'X', 'pid': 1, 'tid': tids[track],
+                            'ts': int((start - deployment_start) * 1e6), 'dur': int(max(0, end - start) * 1e6) })
+    with open(path, 'w') as stream:
+        json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': { 'tag': tag, 'image': docker_image } }, stream)
+
+def write_output(path, cluster):
+    # Written beside the target then renamed over it, so that the output file is never left half written
+    temporary_path = '%s.%s.tmp' % (path, uuid4())
+    with open(temporary_path, 'w') as stream:
+        stream.write(yaml.dump(cluster, default_flow_style = False))
+    os.rename(temporary_path, path)
 
 def usage():
-    die('''     %s -i repo/image:latest -t tag -c cluster.yml -o output.yml [-k kube.config] [-n namespace] [-d --debug]
+    die('''     %s -i repo/image:latest -t tag -c cluster.yml -o output.yml [-k kube.config] [-n namespace] [-u previous.yml] [-p parallelism] [-r retries] [-T trace.json] [-L logs-dir] [-l log-limit] [-z] [-P] [-W prepull-timeout] [-d --debug]
+     %s -b batch.yml [-i repo/image:latest] [-k kube.config] [-n namespace] [-p parallelism] [-r retries] [-L logs-dir] [-l log-limit] [-z] [-P] [-W prepull-timeout] [-d --debug]
     
                 # -i / --image              Docker IRI image to use, relative to Hub
                 # -t / --tag                ID to tag the deployment with
@@ -50,11 +186,22 @@ def usage():
                 # -k / --kubeconfig         Path of the kubectl config file to access the K8S cluster
                 # -x / --ixis               Base path for IXI modules to be specified in cluster configuration
                 # -e / --extras             Additional commands to be run at pod creation
+                # -u / --update             Output file of a previous deployment of the same tag to update in place
+                # -p / --parallelism        Maximum number of concurrent Kubernetes API calls, defaults to 10
+                # -r / --retries            Retries for throttled (429) or failed (5xx) Kubernetes API calls, defaults to 5
+                # -T / --trace              output file for the deployment timings in Chrome trace JSON format
+                # -L / --logs               Directory for the log files of the nodes, defaults to the output file name with a -logs suffix
+                # -l / --log-limit          Maximum bytes of log saved per node, defaults to 64MB, 0 for no limit
+                # -z / --compress-logs      gzip the log files of the nodes
+                # -P / --prepull            Pin the IRI image to its current digest and pull it on every node before creating the pods
+                # -W / --prepull-timeout    Seconds to wait for the image to be pulled on every node, defaults to 600
+                # -b / --batch              YAML file listing several deployments (tag, cluster, output, and optionally image, update, trace, logs) to run together
                 # -d / --debug              print debug information
-        ''' % __file__)
+        ''' % (__file__, __file__))
 
 def parse_opts(opts):
-    global docker_image, tag, kubeconfig, cluster, output, debug, namespace, ixis_path, extras_cmd
+    global docker_image, tag, kubeconfig, cluster, output, debug, namespace, ixis_path, extras_cmd, parallelism, api_retries, previous, trace
+    global logs_path, log_limit_bytes, compress_logs, batch, prepull, prepull_timeout
     if len(opts[0]) == 0:
         usage()
     for (key, value) in opts:
@@ -74,74 +221,496 @@ def parse_opts(opts):
             ixis_path = value
         elif key == '-e' or key == '--extras':
             extras_cmd = value
+        elif key == '-u' or key == '--update':
+            previous = value
+        elif key == '-p' or key == '--parallelism':
+            parallelism = int(value)
+        elif key == '-r' or key == '--retries':
+            api_retries = int(value)
+        elif key == '-T' or key == '--trace':
+            trace = value
+        elif key == '-L' or key == '--logs':
+            logs_path = value
+        elif key == '-l' or key == '--log-limit':
+            log_limit_bytes = int(value)
+        elif key == '-z' or key == '--compress-logs':
+            compress_logs = True
+        elif key == '-b' or key == '--batch':
+            batch = value
+        elif key == '-P' or key == '--prepull':
+            prepull = True
+        elif key == '-W' or key == '--prepull-timeout':
+            prepull_timeout = int(value)
         elif key == '-d' or key == '--debug':
             debug = True
         else:
             usage()
-    if not docker_image or not tag or not cluster or not output:
+    if batch is None and (not docker_image or not tag or not cluster or not output):
+        usage()
+    if batch is not None and (tag or cluster or output or previous or trace):
+        usage()
+    if parallelism < 1 or api_retries < 0 or log_limit_bytes < 0 or prepull_timeout < 0:
         usage()
 
-def add_node_neighbor(node, protocol, host, port):
+def init_iri_session():
+    # Connection-pooled session for the IRI APIs, sized on the number of concurrent callers
+    retries = urllib3.util.retry.Retry(total = api_retries, backoff_factor = retry_backoff,
+                                       status_forcelist = retryable_statuses, method_whitelist = False)
+    adapter = requests.adapters.HTTPAdapter(pool_connections = parallelism, pool_maxsize = parallelism, max_retries = retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(api_headers)
+    return session
+
+def call_iri_api(session, node, payload):
     url = 'http://%s:%s' % (node['host'], node['ports']['api'])
+    response = session.post(url, data = json.dumps(payload), timeout = iri_api_timeout)
+    if response.status_code != 200:
+        raise RuntimeError('%s failed with HTTP status %d: %s' % (payload['command'], response.status_code, response.text))
+    return response.json()
+
+def add_node_neighbors(session, node, uris):
     payload = {
                 'command': 'addNeighbors',
-                'uris': ['%s://%s:%s' % (protocol, host, port)]
+                'uris': uris
               }
-    requests.post(url, headers = api_headers, data = json.dumps(payload))
+    return call_iri_api(session, node, payload)['addedNeighbors']
 
-def wait_until_iri_api_is_healthy(node):
-    url = 'http://%s:%s' % (node.api, node.api_port)
+def remove_node_neighbors(session, node, uris):
+    payload = {
+                'command': 'removeNeighbors',
+                'uris': uris
+              }
+    return call_iri_api(session, node, payload)['removedNeighbors']
+
+def node_neighbors_uris(cluster, node):
+    uris = []
+    for neighbor in cluster['nodes'][node].get('neighbors'):
+        m = neighbor_regex.match(neighbor)
+        if not m:
+            raise RuntimeError('Invalid neighbor %s for node %s' % (neighbor, node))
+        protocol = m.group(1)
+        host = m.group(2)
+        port = m.group(3)
+        if host in cluster['nodes'].keys():
+            if not cluster['nodes'][host]['status'] == 'Running':
+                continue
+            host = cluster['nodes'][host]['podip']
+        uri = '%s://%s:%s' % (protocol, host, port)
+        if uri not in uris:
+            uris.append(uri)
+    return uris
+
+def wait_until_iri_api_is_healthy(session, node, timeout = 120):
+    # The readiness probe only checks that the API port accepts connections, not that IRI answers on it
     payload = {
                 'command': 'getNodeInfo'
               }
-    try:
-        requests.post(url, headers = api_headers, data = json.dumps(payload), timeout = 5)
-    except:
-        time.sleep(1)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return call_iri_api(session, node, payload)
+        except (requests.exceptions.RequestException, RuntimeError, ValueError) as e:
+            if time.time() >= deadline:
+                raise RuntimeError('IRI API is not healthy: %s' % e)
+            time.sleep(1)
+
+def neighbor_links(cluster):
+    # Nodes of the cluster linked to each node, whichever of the two lists the other as neighbor
+    links = { node: set() for node in cluster['nodes'] }
+    for (node, properties) in cluster['nodes'].items():
+        for neighbor in properties.get('neighbors', []):
+            host = neighbor_regex.match(neighbor).group(2)
+            if host in links:
+                links[node].add(host)
+                links[host].add(node)
+    return links
 
 def validate_cluster(cluster):
-    pass
+    # Definition errors are reported before anything is deployed rather than once the nodes are up
+    if type(cluster) is not dict or type(cluster.get('nodes')) is not dict or not cluster['nodes']:
+        die("The cluster definition needs nodes, or a topology to generate them")
+    listed = set()
+    duplicated = []
+    for (node, properties) in cluster['nodes'].items():
+        if not isinstance(node, string_types) or not node_name_regex.match(node):
+            die("Invalid node name %s: use up to 63 letters, digits, dashes, underscores and dots, starting and ending with a letter or digit" % node)
+        if type(properties) is not dict:
+            die("The properties of node %s must be a mapping" % node)
+        neighbors = properties.get('neighbors', [])
+        if type(neighbors) is not list:
+            die("The neighbors of node %s must be a list" % node)
+        for (index, neighbor) in enumerate(neighbors):
+            m = neighbor_regex.match(neighbor) if isinstance(neighbor, string_types) else None
+            if not m:
+                die("Invalid neighbor %s for node %s, expected protocol://host:port" % (neighbor, node))
+            if m.group(2) == node:
+                die("Node %s lists itself as neighbor" % node)
+            if neighbor in neighbors[:index]:
+                duplicated.append((node, neighbor))
+            listed.add((node, m.group(2)))
+    if duplicated:
+        print("%d neighbors are listed twice by the same node, e.g. %s by %s: they are only added once"
+              % (len(duplicated), duplicated[0][1], duplicated[0][0]), file = sys.stderr)
+    one_sided = [ link for link in listed if link[1] in cluster['nodes'] and (link[1], link[0]) not in listed ]
+    if one_sided:
+        print("%d neighbors are listed by one node only, e.g. %s by %s: IRI only gossips with neighbors added on both sides"
+              % (len(one_sided), one_sided[0][1], one_sided[0][0]), file = sys.stderr)
+    if 'topology' in cluster:
+        print_message("Generated topology: %s" % generate_topology.describe_topology(cluster))
+
+def neighbors_anti_affinity(tag, nodes):
+    # Neighbors exchange every transaction they see, so they are preferably kept on different Kubernetes
+    # nodes, not to have a whole neighborhood saturate the network of one of them
+    return {
+             'podAntiAffinity': {
+               'preferredDuringSchedulingIgnoredDuringExecution': [ {
+                 'weight': 100,
+                 'podAffinityTerm': {
+                   'labelSelector': {
+                     'matchLabels': { 'app': 'iri', 'tag': tag },
+                     'matchExpressions': [ { 'key': 'nodenum', 'operator': 'In', 'values': sorted(node.lower() for node in nodes) } ]
+                   },
+                   'topologyKey': 'kubernetes.io/hostname'
+                 }
+               } ]
+             }
+           }
+
+def init_templates():
+    # Templates are compiled once per run, and their bytecode is cached across runs
+    return Environment(loader = FileSystemLoader(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'configs')),
+                       bytecode_cache = FileSystemBytecodeCache())
+
+def render_template(name, **placeholders):
+    return templates.get_template(name).render(**placeholders)
+
+def render_resource(name, **placeholders):
+    return yaml.load(render_template(name, **placeholders), Loader = yaml.SafeLoader)
+
+def sentinel(variable):
+    return 'tiab-sentinel-%s' % variable.lower()
+
+def render_base_resource(name, variables, **placeholders):
+    # Renders and parses a template once, with sentinels in place of the given per-resource variables:
+    # make_resource() then derives every resource of the kind from it without going through YAML again
+    for variable in variables:
+        placeholders[variable] = sentinel(variable)
+    return render_resource(name, **placeholders)
+
+def substitute_sentinels(value, values):
+    # Values are put in as they are given, without YAML typing them: unlike a direct render, a node named 1
+    # keeps the label value '1' instead of the integer 1, which the API would reject
+    if isinstance(value, dict):
+        return { substitute_sentinels(key, values): substitute_sentinels(item, values) for (key, item) in value.items() }
+    elif isinstance(value, list):
+        return [ substitute_sentinels(item, values) for item in value ]
+    elif isinstance(value, string_types) and 'tiab-sentinel-' in value:
+        if value in values:
+            # An empty placeholder renders as a YAML null, not as an empty string
+            return values[value] if values[value] != '' else None
+        return sentinel_regex.sub(lambda match: values[match.group(0)], value)
+    return value
+
+def make_resource(base_resource, **values):
+    return substitute_sentinels(base_resource, { sentinel(variable): value for (variable, value) in values.items() })
 
 def init_k8s_client():
     kubernetes.config.load_kube_config(config_file = kubeconfig)
-    return kubernetes.client.CoreV1Api()
-
-def wait_until_pod_running(kubernetes_client, namespace, pod_name, timeout = 600):
-    for _ in range(0, timeout):
-        pod = kubernetes_client.read_namespaced_pod(pod_name, namespace)
-        if pod.status.phase == 'Running':
-            return True
-        elif pod.status.phase == 'Failed':
-            break
-        time.sleep(1)
-    raise RuntimeError('Pod did not run correctly.')
+    # Keep one pooled connection per concurrent API call instead of reconnecting, plus one for the pods watch
+    configuration = kubernetes.client.Configuration()
+    configuration.connection_pool_maxsize = max(configuration.connection_pool_maxsize, parallelism + 1)
+    return kubernetes.client.CoreV1Api(kubernetes.client.ApiClient(configuration))
 
-def wait_until_pod_ready(kubernetes_client, namespace, pod_name, timeout = 600):
-    for _ in range(0, timeout):
-        pod = kubernetes_client.read_namespaced_pod(pod_name, namespace)
-        if pod.status.phase == 'Failed':
-            break
+def call_with_retries(function, *args, **kwargs):
+    for attempt in range(0, api_retries + 1):
         try:
-            if reduce(lambda ready, container: ready and container.ready, pod.status.container_statuses, True):
-                return pod
-        except TypeError:
-            pass
-        finally:
+            with api_slots:
+                return function(*args, **kwargs)
+        except kubernetes.client.rest.ApiException as e:
+            if e.status not in retryable_statuses or attempt == api_retries:
+                raise e
+            retry_after = e.headers.get('Retry-After') if e.headers else None
+            if retry_after and retry_after.isdigit():
+                delay = int(retry_after)
+            else:
+                # Exponential backoff with full jitter, so that parallel callers do not retry in lockstep
+                delay = random.uniform(0, min(retry_backoff_max, retry_backoff * 2 ** attempt))
+            print_message("API call %s failed with status %s, retrying in %.1fs" % (function.__name__, e.status, delay))
+            time.sleep(delay)
+
+def run_parallel(function, items):
+    pool = ThreadPool(min(parallelism, max(len(items), 1)))
+    try:
+        return pool.map(function, items, chunksize = 1)
+    finally:
+        pool.close()
+        pool.join()
+
+def create_resources(kubernetes_client, resources):
+    rbac_client = kubernetes.client.RbacAuthorizationV1Api(kubernetes_client.api_client)
+    apps_client = kubernetes.client.AppsV1Api(kubernetes_client.api_client)
+    creators = {
+                 'ConfigMap': kubernetes_client.create_namespaced_config_map,
+                 'Pod': kubernetes_client.create_namespaced_pod,
+                 'Service': kubernetes_client.create_namespaced_service,
+                 'ServiceAccount': kubernetes_client.create_namespaced_service_account,
+                 'Role': rbac_client.create_namespaced_role,
+                 'RoleBinding': rbac_client.create_namespaced_role_binding,
+                 'DaemonSet': apps_client.create_namespaced_daemon_set
+               }
+    readers = {
+                'ConfigMap': kubernetes_client.read_namespaced_config_map,
+                'Pod': kubernetes_client.read_namespaced_pod,
+                'Service': kubernetes_client.read_namespaced_service,
+                'ServiceAccount': kubernetes_client.read_namespaced_service_account,
+                'Role': rbac_client.read_namespaced_role,
+                'RoleBinding': rbac_client.read_namespaced_role_binding,
+                'DaemonSet': apps_client.read_namespaced_daemon_set
+              }
+    def create_resource(resource):
+        attempts = []
+        def create(*args, **kwargs):
+            attempts.append(True)
+            try:
+                return creators[resource['kind']](*args, **kwargs)
+            except kubernetes.client.rest.ApiException as e:
+                # A failed attempt may still have created the resource, only its response was lost
+                if e.status != 409 or len(attempts) == 1: raise e
+                return readers[resource['kind']](resource['metadata']['name'], namespace)
+        create.__name__ = creators[resource['kind']].__name__
+        return call_with_retries(create, namespace, resource, pretty = True)
+    return run_parallel(create_resource, resources)
+
+def delete_resources(kubernetes_client, resources):
+    rbac_client = kubernetes.client.RbacAuthorizationV1Api(kubernetes_client.api_client)
+    apps_client = kubernetes.client.AppsV1Api(kubernetes_client.api_client)
+    deleters = {
+                 'ConfigMap': kubernetes_client.delete_namespaced_config_map,
+                 'Pod': kubernetes_client.delete_namespaced_pod,
+                 'Service': kubernetes_client.delete_namespaced_service,
+                 'ServiceAccount': kubernetes_client.delete_namespaced_service_account,
+                 'Role': rbac_client.delete_namespaced_role,
+                 'RoleBinding': rbac_client.delete_namespaced_role_binding,
+                 'DaemonSet': apps_client.delete_namespaced_daemon_set
+               }
+    def delete_resource(resource):
+        (kind, name) = resource
+        try:
+            call_with_retries(deleters[kind], name, namespace)
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 404: raise e
+    run_parallel(delete_resource, resources)
+
+def node_resources_names(properties):
+    # Names of the Kubernetes objects backing a node in an output file
+    resources = [ (kind, properties[key]) for (kind, key) in [ ('Pod', 'podname'),
+                                                               ('Service', 'servicename'),
+                                                               ('Service', 'clusteripname') ] if key in properties ]
+    return resources + monitoring_resources_names(properties)
+
+def monitoring_resources_names(properties):
+    if 'tanglescope_podname' not in properties:
+        return []
+    return [ ('Pod', properties['tanglescope_podname']),
+             ('Service', properties['tanglescope_clusteripname']),
+             ('ConfigMap', 'tanglescope-%s' % properties['uuid']) ]
+
+def node_spec_hash(pod_resource, node_uuid, upload_ixis_paths, config_map_resources):
+    # Identifies what a node runs, regardless of its random UUID, to tell which nodes an update must recreate
+    digest = hashlib.sha256(json.dumps(pod_resource, sort_keys = True).replace(node_uuid, '').encode('utf-8'))
+    for config_map_resource in config_map_resources:
+        digest.update(json.dumps(config_map_resource['data'], sort_keys = True).encode('utf-8'))
+    for ixi_path in upload_ixis_paths:
+        digest.update(ixi_content_hash(ixi_path).encode('utf-8'))
+    return digest.hexdigest()
+
+def pod_is_running(pod):
+    return pod.status.phase == 'Running'
+
+def pod_is_ready(pod):
+    try:
+        return reduce(lambda ready, container: ready and container.ready, pod.status.container_statuses, True)
+    except TypeError:
+        return False
+
+def iri_is_ready(pod):
+    # A node is ready once IRI is, whatever its tanglescope sidecar does: the sidecar may have exited,
+    # for good since pods are never restarted, while IRI was still downloading its database
+    try:
+        return [ e for e in pod.status.container_statuses if e.name == 'iri' ][0].ready
+    except (TypeError, IndexError):
+        return False
+
+def wait_until_pods(kubernetes_client, namespace, pod_names, condition, timeout = 600, on_resolved = None, **selectors):
+    # Follows all the selected pods through a single list + watch stream, so that waiting for N pods
+    # costs one API connection and lasts as long as the slowest pod instead of the sum of all of them.
+    # Returns the pods which met the condition; pods that failed, vanished or timed out are left out.
+    if pods_watch_selector is not None:
+        return wait_until_watched_pods(pod_names, condition, timeout, on_resolved)
+    pending = set(pod_names)
+    pods = {}
+    deadline = time.time() + timeout
+
+    def resolve(name, pod):
+        pending.discard(name)
+        if pod is not None:
+            pods[name] = pod
+        if on_resolved:
+            on_resolved(name, pod)
+
+    def update(event_type, pod):
+        name = pod.metadata.name
+        if name not in pending:
+            return
+        if event_type == 'DELETED' or pod.status.phase in ('Failed', 'Succeeded'):
+            print_message("Pod %s did not start correctly" % name)
+            resolve(name, None)
+        elif condition(pod):
+            resolve(name, pod)
+
+    resource_version = None
+    while pending and time.time() < deadline:
+        try:
+            if resource_version is None:
+                pod_list = call_with_retries(kubernetes_client.list_namespaced_pod, namespace, **selectors)
+                listed = set()
+                for pod in pod_list.items:
+                    listed.add(pod.metadata.name)
+                    update('ADDED', pod)
+                for name in pending - listed:
+                    resolve(name, None)
+                resource_version = pod_list.metadata.resource_version
+                continue
+            watch = kubernetes.watch.Watch()
+            for event in watch.stream(kubernetes_client.list_namespaced_pod, namespace,
+                                      resource_version = resource_version,
+                                      timeout_seconds = max(1, int(deadline - time.time())),
+                                      **selectors):
+                if event['type'] == 'ERROR':
+                    # Most likely our resource version expired (410 Gone): start over from a fresh list
+                    resource_version = None
+                    break
+                resource_version = event['object'].metadata.resource_version
+                update(event['type'], event['object'])
+                if not pending:
+                    watch.stop()
+        except (kubernetes.client.rest.ApiException, urllib3.exceptions.HTTPError) as e:
+            print_message("Watching pods failed, listing them again: %s" % e)
+            resource_version = None
+            time.sleep(1)
+
+    for name in list(pending):
+        print_message("Timed out waiting for pod %s" % name)
+        resolve(name, None)
+    return pods
+
+def watch_pods(kubernetes_client, label_selector):
+    # Keeps watched_pods up to date with the pods of all the deployments of a batch through one list
+    # + watch stream, on which each deployment waits for its own pods instead of watching them itself
+    global watched_pods
+    resource_version = None
+    while True:
+        try:
+            if resource_version is None:
+                pod_list = call_with_retries(kubernetes_client.list_namespaced_pod, namespace, label_selector = label_selector)
+                with watched_pods_changed:
+                    # Pods that vanished while the watch was down are known as deleted
+                    pods = { name: None for name in watched_pods or {} }
+                    pods.update((pod.metadata.name, pod) for pod in pod_list.items)
+                    watched_pods = pods
+                    watched_pods_changed.notify_all()
+                resource_version = pod_list.metadata.resource_version
+            watch = kubernetes.watch.Watch()
+            for event in watch.stream(kubernetes_client.list_namespaced_pod, namespace, label_selector = label_selector,
+                                      resource_version = resource_version, timeout_seconds = 300):
+                if event['type'] == 'ERROR':
+                    resource_version = None
+                    break
+                resource_version = event['object'].metadata.resource_version
+                with watched_pods_changed:
+                    watched_pods[event['object'].metadata.name] = event['object'] if event['type'] != 'DELETED' else None
+                    watched_pods_changed.notify_all()
+        except (kubernetes.client.rest.ApiException, urllib3.exceptions.HTTPError) as e:
+            print_message("Watching pods failed, listing them again: %s" % e)
+            resource_version = None
             time.sleep(1)
-    raise RuntimeError('Pod did not start correctly.')
+
+def wait_until_watched_pods(pod_names, condition, timeout = 600, on_resolved = None):
+    # Same as wait_until_pods, on the pods followed by watch_pods
+    pending = set(pod_names)
+    pods = {}
+    deadline = time.time() + timeout
+    while pending and time.time() < deadline:
+        resolved = []
+        with watched_pods_changed:
+            for name in pending:
+                if watched_pods is None or name not in watched_pods:
+                    continue
+                pod = watched_pods[name]
+                if pod is None or pod.status.phase in ('Failed', 'Succeeded'):
+                    print_message("Pod %s did not start correctly" % name)
+                    resolved.append((name, None))
+                elif condition(pod):
+                    resolved.append((name, pod))
+            if not resolved:
+                watched_pods_changed.wait(max(0, deadline - time.time()))
+        for (name, pod) in resolved:
+            pending.discard(name)
+            if pod is not None:
+                pods[name] = pod
+            if on_resolved:
+                on_resolved(name, pod)
+
+    for name in list(pending):
+        print_message("Timed out waiting for pod %s" % name)
+        if on_resolved:
+            on_resolved(name, None)
+    return pods
+
+def wait_until_pod_ready(kubernetes_client, namespace, pod_name, timeout = 600):
+    pods = wait_until_pods(kubernetes_client, namespace, [ pod_name ], pod_is_ready, timeout,
+                           field_selector = 'metadata.name=%s' % pod_name)
+    if pod_name not in pods:
+        raise RuntimeError('Pod did not start correctly.')
+    return pods[pod_name]
+
+def ixi_content_hash(source_dir):
+    # Hash of the module's relative file names and contents: identical modules share one tarball
+    if source_dir in ixi_hashes:
+        return ixi_hashes[source_dir]
+    root = os.path.join(ixis_path, source_dir)
+    digest = hashlib.sha256(os.path.basename(source_dir).encode('utf-8'))
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            digest.update(b'\0' + os.path.relpath(path, root).encode('utf-8') + b'\0')
+            with open(path, 'rb') as stream:
+                for chunk in iter(lambda: stream.read(ixi_chunk_size), b''):
+                    digest.update(chunk)
+    ixi_hashes[source_dir] = digest.hexdigest()
+    return ixi_hashes[source_dir]
 
 def make_tarfile(source_dir):
-    with TemporaryFile() as tar_buffer:
-        with tarfile.open(fileobj = tar_buffer, mode = "w:gz") as tar:
+    tarball_path = os.path.join(ixi_cache_dir, '%s.tar.gz' % ixi_content_hash(source_dir))
+    if not os.path.exists(tarball_path):
+        print_message("Compressing IXI path %s" % source_dir)
+        temporary_path = '%s.%s.tmp' % (tarball_path, uuid4())
+        with tarfile.open(temporary_path, mode = "w:gz") as tar:
             tar.add(os.path.join(ixis_path, source_dir), arcname = os.path.basename(source_dir))
-        tar_buffer.seek(0)
-        return tar_buffer.read()
+        os.rename(temporary_path, tarball_path)
+    return tarball_path
 
-def upload_ixi_modules(kubernetes_client, node):
+def upload_ixi_modules(kubernetes_client, node, tarballs):
     # This command will extract the uploaded archive, making also sure the extracted directory name is stripped from the .ixi suffix.
-    upload_command = ['tar', 'zxvf', '-', '-C', '/iri/data/ixi', '--transform', 's/.ixi//']
-    wait_until_pod_running(kubernetes_client, namespace, node['podname'])
-    kubernetes.stream.stream(kubernetes_client.connect_get_namespaced_pod_exec,
+    # The exec API cannot close stdin, so head ends the input of tar once the whole archive is received.
+    upload_command = "head -c %d | tar zxf - -C /iri/data/ixi --transform 's/.ixi//'"
+    # stream() swaps the request method of the client it is given while it connects, which breaks any other
+    # call made meanwhile on that client: uploads get their own client, never used by another thread
+    exec_client = kubernetes.client.CoreV1Api(kubernetes.client.ApiClient(kubernetes_client.api_client.configuration))
+    kubernetes.stream.stream(exec_client.connect_get_namespaced_pod_exec,
                               node['podname'],
                               namespace,
                               command = [ 'mkdir', '-p', '/iri/data/ixi' ],
@@ -151,81 +720,148 @@ def upload_ixi_modules(kubernetes_client, node):
 
     for ixi_path in node['upload_ixis_paths']:
         print_message("Uploading IXI path %s to %s" % (ixi_path, node['podname']))
-        upload_data = make_tarfile(ixi_path)
-        socket = kubernetes.stream.stream(kubernetes_client.connect_get_namespaced_pod_exec,
+        socket = kubernetes.stream.stream(exec_client.connect_get_namespaced_pod_exec,
                                            node['podname'],
                                            namespace,
-                                           command = upload_command,
+                                           command = [ 'sh', '-c', upload_command % os.path.getsize(tarballs[ixi_path]) ],
                                            stderr = True, stdin = True,
                                            stdout = True, tty = False,
                                            _preload_content = False
                                          )
-        socket.write_stdin(upload_data)
-        socket.close()
-
-def deploy_monitoring(kubernetes_client, cluster):
-    with open('configs/tanglescope.j2', 'r') as stream:
-        tanglescope_config_template = Template(stream.read())
-    with open('configs/tanglescope-configmap.j2', 'r') as stream:
-        tanglescope_configmap_template = Template(stream.read())
-    with open('configs/tanglescope-pod.j2', 'r') as stream:
-        tanglescope_pod_template = Template(stream.read())
-    with open('configs/tanglescope-clusterip.j2', 'r') as stream:
-        tanglescope_clusterip_template = Template(stream.read())
-    with open('configs/prometheus.j2', 'r') as stream:
-        prometheus_config_template = Template(stream.read())
-    with open('configs/prometheus-configmap.j2', 'r') as stream:
-        prometheus_configmap_template = Template(stream.read())
-    with open('configs/prometheus-grafana-pod.j2', 'r') as stream:
-        prometheus_grafana_pod_template = Template(stream.read())
-    with open('configs/prometheus-grafana-service.j2', 'r') as stream:
-        prometheus_grafana_service_template = Template(stream.read())
-    for node in cluster['nodes'].keys():
-        tanglescope_config = tanglescope_config_template.render(iri_target = cluster['nodes'][node]['clusterip'])
-        tanglescope_configmap_resource = yaml.load(tanglescope_configmap_template.render(
-            TAG_PLACEHOLDER = tag,
-            NODE_UUID_PLACEHOLDER = cluster['nodes'][node]['uuid']
-        ), Loader = yaml.SafeLoader)
-        tanglescope_pod_resource = yaml.load(tanglescope_pod_template.render(
-            TAG_PLACEHOLDER = tag,
-            NODE_UUID_PLACEHOLDER = cluster['nodes'][node]['uuid']
-        ), Loader = yaml.SafeLoader)
-        tanglescope_clusterip_resource = yaml.load(tanglescope_clusterip_template.render(
-            TAG_PLACEHOLDER = tag,
-            NODE_UUID_PLACEHOLDER = cluster['nodes'][node]['uuid']
-        ), Loader = yaml.SafeLoader)
-        tanglescope_configmap_resource['data']['tanglescope.yml'] = tanglescope_config
-        kubernetes_client.create_namespaced_config_map(namespace, tanglescope_configmap_resource, pretty = True)
-        pod = kubernetes_client.create_namespaced_pod(namespace, tanglescope_pod_resource, pretty = True)
-        clusterip = kubernetes_client.create_namespaced_service(namespace, tanglescope_clusterip_resource, pretty = True)
+        try:
+            with open(tarballs[ixi_path], 'rb') as tarball:
+                for chunk in iter(lambda: tarball.read(ixi_chunk_size), b''):
+                    # write_stdin() prepends the channel as a str, which cannot be joined to bytes on Python 3
+                    socket.sock.send(b'\x00' + chunk, opcode = ABNF.OPCODE_BINARY)
+            # The API server sends the exit status of the command on the error channel, then closes the connection
+            socket.run_forever(timeout = ixi_upload_timeout)
+            if socket.is_open():
+                raise RuntimeError('extraction of IXI path %s did not finish in %ds' % (ixi_path, ixi_upload_timeout))
+            status = json.loads(socket.read_channel(kubernetes.stream.ws_client.ERROR_CHANNEL) or '{}')
+            if status.get('status') != 'Success':
+                raise RuntimeError('extraction of IXI path %s failed: %s %s' % (ixi_path, status.get('message', 'no exit status'), socket.read_stderr().strip()))
+        finally:
+            socket.close()
+
+def parse_image_reference(image):
+    # Splits an image reference the way Docker does: the first path component is a registry only if it
+    # looks like a host name, otherwise the image comes from Docker Hub
+    (name, _, digest) = image.partition('@')
+    (registry, path) = name.split('/', 1) if '/' in name else (None, name)
+    if registry is not None and not ('.' in registry or ':' in registry or registry == 'localhost'):
+        (registry, path) = (None, name)
+    if registry is None:
+        registry = 'registry-1.docker.io'
+        path = path if '/' in path else 'library/%s' % path
+    (repository, _, tag) = path.partition(':') if ':' in path.split('/')[-1] else (path, None, None)
+    return (name[:len(name) - len(tag) - 1] if tag else name, registry, repository, digest or tag or 'latest')
+
+def resolve_image_digest(image):
+    # Asks the registry which manifest the image tag points to now, getting an anonymous pull token if required
+    (_, registry, repository, reference) = parse_image_reference(image)
+    scheme = 'http' if registry.split(':')[0] in [ 'localhost', '127.0.0.1' ] else 'https'
+    url = '%s://%s/v2/%s/manifests/%s' % (scheme, registry, repository, reference)
+    headers = { 'Accept': ', '.join(manifest_media_types) }
+    response = requests.head(url, headers = headers, timeout = registry_timeout)
+    challenge = response.headers.get('WWW-Authenticate', '')
+    if response.status_code == 401 and challenge.startswith('Bearer '):
+        parameters = dict(bearer_challenge_regex.findall(challenge))
+        token = requests.get(parameters.pop('realm'), params = parameters, timeout = registry_timeout).json()
+        headers['Authorization'] = 'Bearer %s' % token.get('token', token.get('access_token'))
+        response = requests.head(url, headers = headers, timeout = registry_timeout)
+    if response.status_code != 200 or 'Docker-Content-Digest' not in response.headers:
+        raise RuntimeError('registry answered HTTP status %d for %s' % (response.status_code, url))
+    return response.headers['Docker-Content-Digest']
+
+def pin_image(image):
+    # Image reference by digest, so that every pod runs the same image whatever happens to the tag
+    if '@' in image:
+        return image
+    if image not in pinned_images:
+        pinned_images[image] = '%s@%s' % (parse_image_reference(image)[0], resolve_image_digest(image))
+    return pinned_images[image]
+
+def prepull_image(kubernetes_client, tag, docker_image):
+    # A short-lived DaemonSet pulls the image on every node ahead of the pods, which then start from the
+    # local copy. Nodes that did not get the image in time just pull it when their pods start.
+    apps_client = kubernetes.client.AppsV1Api(kubernetes_client.api_client)
+    daemon_set_resource = render_resource('iri-prepull-daemonset.j2', TAG_PLACEHOLDER = tag, IRI_IMAGE_PLACEHOLDER = docker_image)
+    name = daemon_set_resource['metadata']['name']
+    try:
+        create_resources(kubernetes_client, [ daemon_set_resource ])
+    except kubernetes.client.rest.ApiException as e:
+        if json.loads(e.body)['reason'] != 'AlreadyExists': raise e
+        call_with_retries(apps_client.replace_namespaced_daemon_set, name, namespace, daemon_set_resource)
+    try:
+        deadline = time.time() + prepull_timeout
+        while time.time() < deadline:
+            daemon_set = call_with_retries(apps_client.read_namespaced_daemon_set, name, namespace)
+            status = daemon_set.status
+            # After a replace, the status describes the previous generation until the controller catches up
+            updated = (status.observed_generation or 0) >= daemon_set.metadata.generation \
+                      and status.updated_number_scheduled == status.desired_number_scheduled
+            if updated and status.desired_number_scheduled and status.number_ready >= status.desired_number_scheduled:
+                print_message("Image %s pulled on %d nodes" % (docker_image, status.number_ready))
+                return True
+            if updated and not status.desired_number_scheduled:
+                print("No node can run the pre-pull DaemonSet, pods will pull image %s themselves" % docker_image, file = sys.stderr)
+                return False
+            time.sleep(1)
+        print("Timed out pre-pulling image %s, pods will pull it themselves" % docker_image, file = sys.stderr)
+        return False
+    finally:
+        delete_resources(kubernetes_client, [ ('DaemonSet', name) ])
+
+def monitoring_resources(tag, cluster, deploy_prometheus):
+    # Tanglescope reaches its IRI node through the DNS name of the node ClusterIP service, and Prometheus
+    # discovers its targets by itself: none of these resources need the nodes to be deployed first.
+    # As a sidecar, tanglescope is part of the IRI pods instead.
+    tanglescope_configmap_base = render_base_resource('tanglescope-configmap.j2', [ 'NODE_UUID_PLACEHOLDER' ], TAG_PLACEHOLDER = tag)
+    tanglescope_configmap_base['data']['tanglescope.yml'] = render_template('tanglescope.j2', iri_target = sentinel('iri_target'))
+    tanglescope_pod_base = render_base_resource('tanglescope-pod.j2', [ 'NODE_NUMBER_PLACEHOLDER', 'NODE_UUID_PLACEHOLDER' ], TAG_PLACEHOLDER = tag)
+    tanglescope_clusterip_base = render_base_resource('tanglescope-clusterip.j2', [ 'NODE_UUID_PLACEHOLDER' ], TAG_PLACEHOLDER = tag)
+    tanglescope_nodes = [ node for (node, properties) in cluster['nodes'].items() if 'tanglescope_podname' not in properties ]
+    if cluster['monitoring'] == 'sidecar':
+        tanglescope_nodes = []
+    tanglescope_resources = []
+    for node in tanglescope_nodes:
+        node_uuid = cluster['nodes'][node]['uuid']
+        tanglescope_resources.append((node, [
+            make_resource(tanglescope_configmap_base, NODE_UUID_PLACEHOLDER = node_uuid, iri_target = 'iri-clusterip-%s' % node_uuid),
+            make_resource(tanglescope_pod_base, NODE_NUMBER_PLACEHOLDER = node.lower(), NODE_UUID_PLACEHOLDER = node_uuid),
+            make_resource(tanglescope_clusterip_base, NODE_UUID_PLACEHOLDER = node_uuid)
+        ]))
 
+    prometheus_resources = []
+    if deploy_prometheus:
+        prometheus_configmap_resource = render_resource('prometheus-configmap.j2', TAG_PLACEHOLDER = tag)
+        prometheus_configmap_resource['data']['prometheus.yml'] = render_template('prometheus.j2', TAG_PLACEHOLDER = tag, NAMESPACE_PLACEHOLDER = namespace)
+        prometheus_resources = [
+            prometheus_configmap_resource,
+            render_resource('prometheus-serviceaccount.j2', TAG_PLACEHOLDER = tag),
+            render_resource('prometheus-role.j2', TAG_PLACEHOLDER = tag),
+            render_resource('prometheus-rolebinding.j2', TAG_PLACEHOLDER = tag, NAMESPACE_PLACEHOLDER = namespace),
+            render_resource('prometheus-grafana-pod.j2', TAG_PLACEHOLDER = tag),
+            render_resource('prometheus-grafana-service.j2', TAG_PLACEHOLDER = tag)
+        ]
+    return (tanglescope_resources, prometheus_resources)
+
+def record_monitoring_resources(cluster, tanglescope_resources, created):
+    # created holds the tanglescope pods and ClusterIPs, followed by the Grafana pod and service if deployed
+    for (index, (node, _)) in enumerate(tanglescope_resources):
+        pod = created[2 * index]
+        clusterip = created[2 * index + 1]
         cluster['nodes'][node]['tanglescope_podname'] = pod.metadata.name
         cluster['nodes'][node]['tanglescope_clusteripname'] = clusterip.metadata.name
         cluster['nodes'][node]['tanglescope_clusterip'] = clusterip.spec.cluster_ip
         cluster['nodes'][node]['tanglescope_clusterip_ports'] = { p.name: p.port for p in clusterip.spec.ports }
+    if len(created) > 2 * len(tanglescope_resources):
+        (pod, service) = created[-2:]
+        cluster['grafana_podname'] = pod.metadata.name
+        cluster['grafana_servicename'] = service.metadata.name
+        cluster['grafana_port'] = service.spec.ports[0].node_port
 
-    prometheus_config = prometheus_config_template.render(
-        iri_targets = [ properties['clusterip'] for (_, properties) in cluster['nodes'].items() ],
-        tanglescope_targets = [ properties['tanglescope_clusterip'] for (_, properties) in cluster['nodes'].items() ]
-    )
-    prometheus_configmap_resource = yaml.load(prometheus_configmap_template.render(
-        TAG_PLACEHOLDER = tag
-    ), Loader = yaml.SafeLoader)
-    prometheus_grafana_pod_resource = yaml.load(prometheus_grafana_pod_template.render(
-        TAG_PLACEHOLDER = tag
-    ), Loader = yaml.SafeLoader)
-    prometheus_grafana_service_resource = yaml.load(prometheus_grafana_service_template.render(
-        TAG_PLACEHOLDER = tag
-    ), Loader = yaml.SafeLoader)
-    prometheus_configmap_resource['data']['prometheus.yml'] = prometheus_config
-    kubernetes_client.create_namespaced_config_map(namespace, prometheus_configmap_resource, pretty = True)
-    pod = kubernetes_client.create_namespaced_pod(namespace, prometheus_grafana_pod_resource, pretty = True)
-    service = kubernetes_client.create_namespaced_service(namespace, prometheus_grafana_service_resource, pretty = True)
-
-    cluster['grafana_podname'] = pod.metadata.name
-    cluster['grafana_servicename'] = service.metadata.name
-    cluster['grafana_port'] = service.spec.ports[0].node_port
-
+def setup_grafana(kubernetes_client, cluster):
     pod = wait_until_pod_ready(kubernetes_client, namespace, cluster['grafana_podname'])
     cluster['grafana_host'] = pod.spec.node_name
 
@@ -245,87 +881,190 @@ def deploy_monitoring(kubernetes_client, cluster):
               }
     requests.post(url, auth = ('admin', 'admin'), headers = headers, data = json.dumps(payload))
 
-docker_image = None
-namespace = 'default'
-tag = None
-kubeconfig = None
-debug = False
-cluster = None
-output = None
-ixis_path = os.getcwd()
-healthy = True
-extras_cmd = None
-config_extras_cmd = None
-
-if __name__ == '__main__':
-    try:
-        opts = getopt(sys.argv[1:], 'i:t:k:c:n:o:x:e:d', ['image=', 'tag=', 'kubeconfig=', 'cluster=', 'namespace=', 'output=', 'ixis=', 'extras=','debug'])
-        parse_opts(opts[0])
-    except:
-        usage()
-
+def load_deployment(tag, docker_image, cluster, output, previous, trace, logs_path):
+    # Definitions are read, and paths resolved, before the working directory changes to the templates
+    (cluster_path, previous_path) = (cluster, previous)
     with open(cluster, 'r') as stream:
         try:
             cluster = yaml.load(stream, Loader = yaml.SafeLoader)
         except yaml.YAMLError as e:
             die(e)
+    if previous is not None:
+        with open(previous, 'r') as stream:
+            try:
+                previous = yaml.load(stream, Loader = yaml.SafeLoader)
+            except yaml.YAMLError as e:
+                die(e)
+    logs_path = os.path.abspath(logs_path if logs_path is not None else os.path.splitext(output)[0] + '-logs')
+    updated_in_place = previous is not None and os.path.exists(output) and os.path.samefile(previous_path, output)
+    output = os.path.abspath(output)
+    if not os.access(os.path.dirname(output), os.W_OK):
+        die("Cannot write the output file %s" % output)
     try:
-        output = open(output, 'w')
+        if not os.path.isdir(logs_path):
+            os.makedirs(logs_path)
     except Exception as e:
         die(e)
-
-    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    try:
+        generate_topology.expand_topology(cluster)
+    except ValueError as e:
+        die("Invalid topology in %s: %s" % (cluster_path, e))
     validate_cluster(cluster)
-    print_message("Initializing kubernetes client library against cluster")
-    kubernetes_client = init_k8s_client()
-    with open('configs/iri-pod.j2', 'r') as stream:
-        iri_pod_template = Template(stream.read())
-    with open('configs/tiab-entrypoint-configmap.j2', 'r') as stream:
-        tiab_entrypoint_configmap_template = Template(stream.read())
-    with open('configs/iri-service.j2', 'r') as stream:
-        iri_service_template = Template(stream.read())
-    with open('configs/iri-clusterip.j2', 'r') as stream:
-        iri_clusterip_template = Template(stream.read())
-
-    tiab_entrypoint_configmap_resource = yaml.load(tiab_entrypoint_configmap_template.render(
+    return { 'tag': tag, 'docker_image': docker_image, 'cluster': cluster, 'output': output, 'updated_in_place': updated_in_place,
+             'previous': previous, 'trace': os.path.abspath(trace) if trace is not None else None, 'logs_path': logs_path }
+
+def load_batch(path):
+    # A batch lists deployments with the same settings as the command line options of a single one
+    with open(path, 'r') as stream:
+        try:
+            entries = yaml.load(stream, Loader = yaml.SafeLoader)['deployments']
+        except (yaml.YAMLError, KeyError, TypeError) as e:
+            die(e)
+    if type(entries) is not list or not entries:
+        die("The batch file must have a list of deployments")
+    for entry in entries:
+        if not entry.get('tag') or not entry.get('cluster') or not entry.get('output') or not entry.get('image', docker_image):
+            die("Every deployment of the batch needs a tag, a cluster, an output and an image")
+    tags = [ entry['tag'] for entry in entries ]
+    if len(set(tags)) != len(tags):
+        die("The deployments of a batch need distinct tags")
+    return [ load_deployment(entry['tag'], entry.get('image', docker_image), entry['cluster'], entry['output'], entry.get('update'),
+                             entry.get('trace'), entry.get('logs', os.path.join(logs_path, entry['tag']) if logs_path is not None else None))
+             for entry in entries ]
+
+def run_deployment(deployment):
+    # A failed deployment does not stop the rest of a batch: its last known state is written with the error.
+    # A failed update does not replace the output file it updates, which still describes the pods that were
+    # running before it: its state goes to a .failed file beside it instead.
+    output = deployment['output']
+    try:
+        healthy = deploy(deployment['tag'], deployment['docker_image'], deployment['cluster'], deployment['previous'],
+                         deployment['trace'], deployment['logs_path'])
+    except (Exception, KeyboardInterrupt) as e:
+        error = str(e) or type(e).__name__
+        print("Deployment %s failed: %s" % (deployment['tag'], error), file = sys.stderr)
+        print_message(traceback.format_exc())
+        deployment['cluster']['error'] = error
+        healthy = False
+        if deployment['updated_in_place']:
+            output = '%s.failed%s' % os.path.splitext(output)
+            print("Kept %s, the state of the failed update is in %s" % (deployment['output'], output), file = sys.stderr)
+    write_output(output, deployment['cluster'])
+    return healthy
+
+def deploy(tag, docker_image, cluster, previous, trace, logs_path):
+    # Deploys one cluster definition and returns whether all of its nodes are healthy. The deployments
+    # of a batch run this side by side, sharing the Kubernetes client and the API calls budget.
+    healthy = True
+    image_pull_policy = 'Always'
+    if prepull:
+        start_phase(tag, 'resolve_image')
+        try:
+            docker_image = pin_image(docker_image)
+            image_pull_policy = 'IfNotPresent'
+        except (requests.exceptions.RequestException, RuntimeError, ValueError) as e:
+            print("Could not resolve the digest of image %s, deploying it without pre-pulling: %s" % (docker_image, e), file = sys.stderr)
+
+    start_phase(tag, 'templates')
+    tanglescope_sidecar = cluster.get('monitoring') == 'sidecar'
+    tiab_entrypoint_configmap_resource = render_resource('tiab-entrypoint-configmap.j2',
         TAG_PLACEHOLDER = tag,
         EXTRAS_COMMANDS_PLACEHOLDER = extras_cmd if extras_cmd else '',
         CONFIG_EXTRAS_COMMANDS_PLACEHOLDER = cluster['extra_commands'] if 'extra_commands' in cluster else ''
-    ), Loader = yaml.SafeLoader)
+    )
+    node_variables = [ 'NODE_NUMBER_PLACEHOLDER', 'NODE_UUID_PLACEHOLDER' ]
+    iri_service_base = render_base_resource('iri-service.j2', node_variables, TAG_PLACEHOLDER = tag)
+    iri_clusterip_base = render_base_resource('iri-clusterip.j2', node_variables, TAG_PLACEHOLDER = tag)
+    iri_pod_base = render_base_resource('iri-pod.j2', node_variables + [ 'IRI_DB_URL_PLACEHOLDER', 'IRI_DB_CHECKSUM_PLACEHOLDER',
+                                        'IRI_DB_CACHED_PLACEHOLDER', 'IXI_URLS_PLACEHOLDER', 'LOCAL_IXIS_PLACEHOLDER' ],
+                                        TAG_PLACEHOLDER = tag, IRI_IMAGE_PLACEHOLDER = docker_image, IRI_IMAGE_PULL_POLICY_PLACEHOLDER = image_pull_policy,
+                                        TANGLESCOPE_SIDECAR_PLACEHOLDER = tanglescope_sidecar)
+    db_cache_variables = [ 'IRI_DB_URL_PLACEHOLDER', 'IRI_DB_CHECKSUM_PLACEHOLDER', 'DB_CACHE_UUID_PLACEHOLDER' ]
+    iri_db_cache_pod_base = render_base_resource('iri-db-cache-pod.j2', db_cache_variables, TAG_PLACEHOLDER = tag, IRI_IMAGE_PLACEHOLDER = docker_image)
+    iri_db_cache_clusterip_base = render_base_resource('iri-db-cache-clusterip.j2', db_cache_variables, TAG_PLACEHOLDER = tag)
 
-    try:
-        kubernetes_client.create_namespaced_config_map(namespace, tiab_entrypoint_configmap_resource, pretty = True)
-    except kubernetes.client.rest.ApiException as e:
-        if json.loads(e.body)['reason'] != 'AlreadyExists': raise e
+    # Configmaps mounted by every IRI pod of the deployment
+    shared_config_map_resources = [ tiab_entrypoint_configmap_resource ]
+    if tanglescope_sidecar:
+        tanglescope_sidecar_configmap_resource = render_resource('tanglescope-sidecar-configmap.j2', TAG_PLACEHOLDER = tag)
+        tanglescope_sidecar_configmap_resource['data']['tanglescope.yml'] = render_template('tanglescope.j2', iri_target = 'localhost')
+        shared_config_map_resources.append(tanglescope_sidecar_configmap_resource)
 
+    start_phase(tag, 'entrypoint')
+    for config_map_resource in shared_config_map_resources:
+        try:
+            create_resources(kubernetes_client, [ config_map_resource ])
+        except kubernetes.client.rest.ApiException as e:
+            if json.loads(e.body)['reason'] != 'AlreadyExists': raise e
+            if previous is not None:
+                call_with_retries(kubernetes_client.replace_namespaced_config_map, config_map_resource['metadata']['name'],
+                                  namespace, config_map_resource)
+
+    # When updating, only the nodes whose pod would change, or whose pod is gone, are deployed again
+    live_pods = {}
+    stale_resources = []
+    if previous is not None:
+        start_phase(tag, 'list_pods')
+        live_pods = { pod.metadata.name: pod.status.phase for pod in
+                      call_with_retries(kubernetes_client.list_namespaced_pod, namespace, label_selector = 'tag=%s' % tag).items }
+        for (node, properties) in previous['nodes'].items():
+            if node not in cluster['nodes']:
+                print_message("Removing node %s" % node)
+                stale_resources += node_resources_names(properties)
+
+    start_phase(tag, 'render')
     http_url_regex = re.compile('https?://[-A-Za-z0-9\+&@#/%?=~_|!:,.;]*[-A-Za-z0-9\+&@#/%=~_|]')
 
+    # With db_cache enabled every distinct database, keyed by its checksum, is downloaded and verified
+    # once by a cache pod, from which all the IRI pods using it fetch the archive
+    db_cache_resources = []
+    if cluster.get('db_cache'):
+        cluster['db_caches'] = {}
+        for properties in cluster['nodes'].values():
+            if properties.get('db') and properties.get('db_checksum') and properties['db_checksum'] not in cluster['db_caches']:
+                previous_db_cache = previous.get('db_caches', {}).get(properties['db_checksum']) if previous is not None else None
+                if previous_db_cache and live_pods.get(previous_db_cache['podname']) == 'Running':
+                    cluster['db_caches'][properties['db_checksum']] = previous_db_cache
+                    previous_db_cache.pop('timings', None)
+                    continue
+                db_cache_uuid = str(uuid4())
+                cluster['db_caches'][properties['db_checksum']] = { 'db': properties['db'], 'uuid': db_cache_uuid }
+                db_cache_values = {
+                    'IRI_DB_URL_PLACEHOLDER': properties['db'],
+                    'IRI_DB_CHECKSUM_PLACEHOLDER': properties['db_checksum'],
+                    'DB_CACHE_UUID_PLACEHOLDER': db_cache_uuid
+                }
+                db_cache_resources.append((properties['db_checksum'], [
+                    make_resource(iri_db_cache_pod_base, **db_cache_values),
+                    make_resource(iri_db_cache_clusterip_base, **db_cache_values)
+                ]))
+
+    if previous is not None:
+        for (db_checksum, properties) in previous.get('db_caches', {}).items():
+            if cluster.get('db_caches', {}).get(db_checksum) is not properties:
+                stale_resources += [ ('Pod', properties['podname']), ('Service', properties['servicename']) ]
+
+    links = neighbor_links(cluster) if cluster.get('spread_neighbors') else {}
+    node_resources = []
     for (node, properties) in cluster['nodes'].items():
         node_uuid = str(uuid4())
-        iri_service_resource = yaml.load(iri_service_template.render(
-            TAG_PLACEHOLDER = tag,
-            NODE_NUMBER_PLACEHOLDER = node.lower(),
-            NODE_UUID_PLACEHOLDER = node_uuid
-        ), Loader = yaml.SafeLoader)
-        iri_clusterip_resource = yaml.load(iri_clusterip_template.render(
-            TAG_PLACEHOLDER = tag,
-            NODE_NUMBER_PLACEHOLDER = node.lower(),
-            NODE_UUID_PLACEHOLDER = node_uuid
-        ), Loader = yaml.SafeLoader)
+        iri_service_resource = make_resource(iri_service_base, NODE_NUMBER_PLACEHOLDER = node.lower(), NODE_UUID_PLACEHOLDER = node_uuid)
+        iri_clusterip_resource = make_resource(iri_clusterip_base, NODE_NUMBER_PLACEHOLDER = node.lower(), NODE_UUID_PLACEHOLDER = node_uuid)
+
+        cluster['nodes'][node]['upload_ixis_paths'] = [ path for path in properties['ixis'] if not http_url_regex.match(path) ] if 'ixis' in properties else []
 
-        cluster['nodes'][node]['upload_ixis_paths'] = filter(lambda path: not http_url_regex.match(path), properties['ixis']) if 'ixis' in properties else []
+        db_cache = cluster['db_caches'].get(properties.get('db_checksum')) if 'db_caches' in cluster else None
 
-        iri_pod_resource = yaml.load(iri_pod_template.render(
-            TAG_PLACEHOLDER = tag,
-            IRI_IMAGE_PLACEHOLDER = docker_image,
+        iri_pod_resource = make_resource(iri_pod_base,
             NODE_NUMBER_PLACEHOLDER = node.lower(),
-            IRI_DB_URL_PLACEHOLDER = properties['db'] if 'db' in properties else '',
+            IRI_DB_URL_PLACEHOLDER = 'http://iri-db-cache-%s/db.tar' % db_cache['uuid'] if db_cache else properties['db'] if 'db' in properties else '',
             IRI_DB_CHECKSUM_PLACEHOLDER = properties['db_checksum'] if 'db_checksum' in properties else '',
+            IRI_DB_CACHED_PLACEHOLDER = 'xyes' if db_cache else 'xno',
             # Pass only the IXI modules that are downloaded URLs
             IXI_URLS_PLACEHOLDER = ' '.join(filter(http_url_regex.match, properties['ixis'])) if 'ixis' in properties else '',
             NODE_UUID_PLACEHOLDER = node_uuid,
             LOCAL_IXIS_PLACEHOLDER = 'xyes' if cluster['nodes'][node]['upload_ixis_paths'] else 'xno'
-        ), Loader = yaml.SafeLoader)
+        )
 
         iri_container = [e for e in iri_pod_resource['spec']['containers'] if e['name'] == 'iri'][0]
 
@@ -341,55 +1080,343 @@ if __name__ == '__main__':
         elif java_options is not None:
             raise RuntimeError('java_options for node %s is not a string' % node)
 
-        print_message("Deploying %s" % node)
-        iri_pod = kubernetes_client.create_namespaced_pod(namespace, iri_pod_resource, pretty = True)
-        iri_service = kubernetes_client.create_namespaced_service(namespace, iri_service_resource, pretty = True)
-        clusterip = kubernetes_client.create_namespaced_service(namespace, iri_clusterip_resource, pretty = True)
+        spec_hash = node_spec_hash(iri_pod_resource, node_uuid, cluster['nodes'][node]['upload_ixis_paths'], shared_config_map_resources)
+        previous_node = previous['nodes'].get(node) if previous is not None else None
+        if previous_node is not None:
+            if previous_node.get('spec_hash') == spec_hash and previous_node.get('status') == 'Running' \
+               and live_pods.get(previous_node['podname']) == 'Running':
+                print_message("Keeping node %s" % node)
+                for key in node_runtime_keys:
+                    if key in previous_node:
+                        cluster['nodes'][node][key] = previous_node[key]
+                if not cluster.get('monitoring'):
+                    stale_resources += monitoring_resources_names(previous_node)
+                    for key in [ key for key in node_runtime_keys if key.startswith('tanglescope_') ]:
+                        cluster['nodes'][node].pop(key, None)
+                continue
+            print_message("Replacing node %s" % node)
+            stale_resources += node_resources_names(previous_node)
+
+        # Placement only matters when the pod is scheduled, so it is left out of the spec hash: changing the
+        # neighbors of a running node rewires it without replacing its pod
+        if links.get(node):
+            iri_pod_resource['spec']['affinity'] = neighbors_anti_affinity(tag, links[node])
 
         cluster['nodes'][node]['uuid'] = node_uuid
+        cluster['nodes'][node]['spec_hash'] = spec_hash
+        node_resources.append((node, [ iri_pod_resource, iri_service_resource, iri_clusterip_resource ]))
+
+    # Prometheus follows the nodes by itself, so an update only adds tanglescope to the new nodes
+    tanglescope_resources = []
+    prometheus_resources = []
+    if cluster.get('monitoring'):
+        deploy_prometheus = previous is None or 'grafana_podname' not in previous
+        (tanglescope_resources, prometheus_resources) = monitoring_resources(tag, cluster, deploy_prometheus)
+        if not deploy_prometheus:
+            for key in [ 'grafana_podname', 'grafana_servicename', 'grafana_port', 'grafana_host' ]:
+                cluster[key] = previous[key]
+    if previous is not None and previous.get('monitoring') == 'sidecar' and not tanglescope_sidecar:
+        stale_resources += [ ('ConfigMap', 'tanglescope-%s' % tag) ]
+    if not cluster.get('monitoring') and previous is not None and 'grafana_podname' in previous:
+        stale_resources += [ ('Pod', previous['grafana_podname']),
+                             ('Service', previous['grafana_servicename']),
+                             ('ConfigMap', 'prometheus-%s' % tag),
+                             ('ServiceAccount', 'prometheus-%s' % tag),
+                             ('Role', 'prometheus-%s' % tag),
+                             ('RoleBinding', 'prometheus-%s' % tag) ]
+
+    if stale_resources:
+        start_phase(tag, 'delete_stale')
+        print_message("Deleting %d stale resources" % len(stale_resources))
+        delete_resources(kubernetes_client, stale_resources)
+
+    if image_pull_policy == 'IfNotPresent' and node_resources:
+        start_phase(tag, 'prepull')
+        prepull_image(kubernetes_client, tag, docker_image)
+
+    if db_cache_resources:
+        start_phase(tag, 'create_db_caches')
+        db_caches_created_after = time.time()
+        print_message("Deploying %d DB caches" % len(db_cache_resources))
+        created = create_resources(kubernetes_client, [ resource for (_, resources) in db_cache_resources for resource in resources ])
+        for (index, (db_checksum, _)) in enumerate(db_cache_resources):
+            cluster['db_caches'][db_checksum]['podname'] = created[2 * index].metadata.name
+            cluster['db_caches'][db_checksum]['servicename'] = created[2 * index + 1].metadata.name
+
+    start_phase(tag, 'create_nodes')
+    nodes_created_after = time.time()
+    # Configmaps, and the service account Prometheus runs as, must exist before the pods using them
+    monitoring_setup_resources = [ resources[0] for (_, resources) in tanglescope_resources ] + prometheus_resources[:4]
+    if monitoring_setup_resources:
+        create_resources(kubernetes_client, monitoring_setup_resources)
+    print_message("Deploying %d nodes, up to %d API calls at a time" % (len(node_resources), parallelism))
+    created = create_resources(kubernetes_client, [ resource for (_, resources) in node_resources for resource in resources ] +
+                                                  [ resource for (_, resources) in tanglescope_resources for resource in resources[1:] ] +
+                                                  prometheus_resources[4:])
+
+    for (index, (node, _)) in enumerate(node_resources):
+        (iri_pod, iri_service, clusterip) = created[3 * index:3 * index + 3]
         cluster['nodes'][node]['podname'] = iri_pod.metadata.name
         cluster['nodes'][node]['servicename'] = iri_service.metadata.name
         cluster['nodes'][node]['clusteripname'] = clusterip.metadata.name
         cluster['nodes'][node]['ports'] = { p.name: p.node_port for p in iri_service.spec.ports }
         cluster['nodes'][node]['clusterip'] = clusterip.spec.cluster_ip
         cluster['nodes'][node]['clusterip_ports'] = { p.name: p.port for p in clusterip.spec.ports }
+    record_monitoring_resources(cluster, tanglescope_resources, created[3 * len(node_resources):])
 
-    try:
-        if cluster['monitoring']:
-            deploy_monitoring(kubernetes_client, cluster)
-    except KeyError:
-        pass
+    # Every IXI module is compressed once, then streamed to each pod as soon as it is running
+    start_phase(tag, 'ixi_upload')
+    ixi_nodes = { properties['podname']: node for (node, properties) in cluster['nodes'].items() if properties['upload_ixis_paths'] and 'status' not in properties }
+    tarballs = { ixi_path: make_tarfile(ixi_path) for node in ixi_nodes.values() for ixi_path in cluster['nodes'][node]['upload_ixis_paths'] }
+    upload_pool = ThreadPool(parallelism)
+    uploads = {}
+
+    def timed_upload(node):
+        started = time.time()
+        upload_ixi_modules(kubernetes_client, cluster['nodes'][node], tarballs)
+        record_timing(tag, node, 'ixi_upload', started, time.time())
+
+    def start_upload(pod_name, pod):
+        if pod is not None:
+            uploads[ixi_nodes[pod_name]] = upload_pool.apply_async(timed_upload, (ixi_nodes[pod_name], ))
+        else:
+            cluster['nodes'][ixi_nodes[pod_name]]['status'] = 'Error'
 
-    for node in cluster['nodes'].keys():
+    if ixi_nodes:
+        print_message("Uploading %d IXI modules to %d nodes" % (len(tarballs), len(ixi_nodes)))
+        wait_until_pods(kubernetes_client, namespace, ixi_nodes.keys(), pod_is_running,
+                        on_resolved = start_upload, label_selector = 'tag=%s' % tag)
+    upload_pool.close()
+    upload_pool.join()
+    for (node, upload) in uploads.items():
         try:
-            if cluster['nodes'][node]['upload_ixis_paths']:
-                upload_ixi_modules(kubernetes_client, cluster['nodes'][node])
-            pod = wait_until_pod_ready(kubernetes_client, namespace, cluster['nodes'][node]['podname'])
-        except Exception:
-            healthy = False
+            upload.get()
+        except Exception as e:
+            print_message("Could not upload IXI modules to node %s: %s" % (node, e))
+            cluster['nodes'][node]['status'] = 'Error'
+            cluster['nodes'][node]['ixi_error'] = str(e)
+
+    ready_pods = {}
+    if 'db_caches' in cluster:
+        start_phase(tag, 'db_caches_ready')
+        # A node cannot start if its DB cache failed to download or verify the database
+        db_cache_pods = { properties['podname']: db_checksum for (db_checksum, properties) in cluster['db_caches'].items() }
+
+        def mark_db_cache(pod_name, pod):
+            db_checksum = db_cache_pods[pod_name]
+            cluster['db_caches'][db_checksum]['status'] = 'Running' if pod is not None else 'Error'
+            if pod is not None:
+                ready_pods[pod_name] = pod
+            else:
+                for properties in cluster['nodes'].values():
+                    if properties.get('db_checksum') == db_checksum:
+                        properties['status'] = 'Error'
+
+        print_message("Waiting for %d DB caches to become ready" % len(db_cache_pods))
+        wait_until_pods(kubernetes_client, namespace, db_cache_pods.keys(), pod_is_ready,
+                        on_resolved = mark_db_cache, label_selector = 'tag=%s' % tag)
+
+    start_phase(tag, 'nodes_ready')
+    pods_nodes = { properties['podname']: node for (node, properties) in cluster['nodes'].items() if 'status' not in properties }
+
+    def mark_node(pod_name, pod):
+        node = pods_nodes[pod_name]
+        if pod is None:
             cluster['nodes'][node]['status'] = 'Error'
         else:
+            print_message("Node %s is ready" % node)
+            ready_pods[pod_name] = pod
             cluster['nodes'][node]['podip'] = pod.status.pod_ip
             cluster['nodes'][node]['host'] = pod.spec.node_name
             cluster['nodes'][node]['status'] = 'Running'
+
+    print_message("Waiting for %d nodes to become ready" % len(pods_nodes))
+    wait_until_pods(kubernetes_client, namespace, pods_nodes.keys(), iri_is_ready,
+                    on_resolved = mark_node, label_selector = 'tag=%s' % tag)
+
+    if prometheus_resources:
+        start_phase(tag, 'monitoring_ready')
+        setup_grafana(kubernetes_client, cluster)
+
+    def capture_node_log(node):
+        path = os.path.join(logs_path, '%s.log%s' % (node, '.gz' if compress_logs else ''))
+        try:
+            return (node, path) + capture_pod_log(kubernetes_client, cluster['nodes'][node]['podname'], path) + (None, )
+        except Exception as e:
+            return (node, None, None, None, None, e)
+
+    start_phase(tag, 'logs')
+    print_message("Saving the logs of %d nodes to %s" % (len(cluster['nodes']), logs_path))
+    for (node, path, log_tail, markers, truncated, error) in run_parallel(capture_node_log, list(cluster['nodes'].keys())):
+        if cluster['nodes'][node]['status'] != 'Running':
+            healthy = False
+        if error is not None:
+            print_message("Could not save the log of node %s: %s" % (node, error))
+            cluster['nodes'][node]['log_error'] = str(error)
+            continue
+        cluster['nodes'][node]['log_file'] = path
+        cluster['nodes'][node]['log_tail'] = log_tail
+        if truncated:
+            cluster['nodes'][node]['log_truncated'] = True
+        if cluster['nodes'][node]['podname'] in pods_nodes:
+            record_log_timings(tag, node, markers, nodes_created_after)
+
+    # Scheduling, image pull and startup times of the pods deployed by this run
+    start_phase(tag, 'pod_timings')
+    pods_tracks = { pod_name: (node, nodes_created_after) for (pod_name, node) in pods_nodes.items() }
+    for (db_checksum, _) in db_cache_resources:
+        pod_name = cluster['db_caches'][db_checksum]['podname']
+        pods_tracks[pod_name] = (pod_name, db_caches_created_after)
+    timed_pods = [ pod_name for pod_name in ready_pods.keys() if pod_name in pods_tracks ]
+    pods_events = list_pods_events(kubernetes_client, timed_pods)
+    for pod_name in timed_pods:
+        (track, created_after) = pods_tracks[pod_name]
+        record_pod_timings(tag, track, ready_pods[pod_name], pods_events[pod_name], created_after)
+
+    iri_session = init_iri_session()
+
+    def wire_node(node_uris):
+        (node, uris, stale_uris) = node_uris
+        started = time.time()
+        try:
+            wait_until_iri_api_is_healthy(iri_session, cluster['nodes'][node])
+            removed = remove_node_neighbors(iri_session, cluster['nodes'][node], stale_uris) if stale_uris else 0
+            added = add_node_neighbors(iri_session, cluster['nodes'][node], uris) if uris else 0
+            return (node, added, removed, None)
+        except Exception as e:
+            return (node, None, None, e)
         finally:
-            cluster['nodes'][node]['log'] = kubernetes_client.read_namespaced_pod_log(cluster['nodes'][node]['podname'], namespace, pretty = True)
-
-    for node in cluster['nodes'].keys():
-        if 'neighbors' in cluster['nodes'][node] and cluster['nodes'][node]['status'] == 'Running':
-            for neighbor in cluster['nodes'][node].get('neighbors'):
-                m = re.match('^([a-z]+?)://([^:]+?):(\d+)$', neighbor)
-                protocol = m.group(1)
-                host = m.group(2)
-                port = m.group(3)
-                if host in cluster['nodes'].keys():
-                    if not cluster['nodes'][host]['status'] == 'Running':
-                        continue
-                    host = cluster['nodes'][host]['podip']
-                add_node_neighbor(cluster['nodes'][node], protocol, host, port)
-
-
-    if healthy:
-        success(output, cluster)
+            record_timing(tag, node, 'neighbors', started, time.time())
+
+    start_phase(tag, 'neighbors')
+    # Kept nodes only need the neighbors that changed since the previous deployment, including the
+    # ones whose node was replaced and thus moved to another IP address
+    wired_nodes = []
+    for (node, properties) in cluster['nodes'].items():
+        if properties['status'] != 'Running':
+            continue
+        try:
+            uris = node_neighbors_uris(cluster, node) if 'neighbors' in properties else []
+            stale_uris = []
+            if previous is not None and node in previous['nodes'] and properties['uuid'] == previous['nodes'][node].get('uuid'):
+                previous_uris = node_neighbors_uris(previous, node) if 'neighbors' in previous['nodes'][node] else []
+                stale_uris = [ uri for uri in previous_uris if uri not in uris ]
+                uris = [ uri for uri in uris if uri not in previous_uris ]
+                if not uris and not stale_uris:
+                    continue
+            elif 'neighbors' not in properties:
+                continue
+        except Exception as e:
+            print_message("Could not add neighbors to node %s: %s" % (node, e))
+            healthy = False
+            cluster['nodes'][node]['neighbors_error'] = str(e)
+            continue
+        wired_nodes.append((node, uris, stale_uris))
+
+    print_message("Wiring neighbors of %d nodes" % len(wired_nodes))
+    for (node, added, removed, error) in run_parallel(wire_node, wired_nodes):
+        if error is not None:
+            print_message("Could not add neighbors to node %s: %s" % (node, error))
+            healthy = False
+            cluster['nodes'][node]['neighbors_error'] = str(error)
+        else:
+            cluster['nodes'][node]['neighbors_added'] = added
+            if removed:
+                cluster['nodes'][node]['neighbors_removed'] = removed
+
+    start_phase(tag, None)
+    cluster['timings'] = timings_report(tag, 'deployment')
+    cluster['timings']['total'] = { 'start': 0, 'duration': round(time.time() - deployment_start, 3) }
+    for (node, properties) in cluster['nodes'].items():
+        if properties['podname'] in pods_nodes:
+            properties['timings'] = timings_report(tag, node)
+    for properties in cluster.get('db_caches', {}).values():
+        if properties['podname'] in pods_tracks:
+            properties['timings'] = timings_report(tag, properties['podname'])
+    if trace is not None:
+        write_trace(trace, tag, docker_image, [ 'deployment' ] + sorted(cluster['nodes'].keys()) +
+                           sorted(pod_name for (pod_name, track) in pods_tracks.items() if pod_name == track))
+
+    return healthy
+
+docker_image = None
+namespace = 'default'
+tag = None
+kubeconfig = None
+debug = False
+cluster = None
+output = None
+ixis_path = os.getcwd()
+ixi_cache_dir = None
+ixi_hashes = {}
+ixi_chunk_size = 64 * 1024
+ixi_upload_timeout = 300
+previous = None
+extras_cmd = None
+config_extras_cmd = None
+parallelism = 10
+api_retries = 5
+retry_backoff = 0.5
+retry_backoff_max = 30
+iri_api_timeout = 10
+templates = None
+trace = None
+logs_path = None
+log_limit_bytes = 64 * 1024 * 1024
+log_tail_lines = 50
+log_chunk_size = 64 * 1024
+compress_logs = False
+batch = None
+prepull = False
+prepull_timeout = 600
+registry_timeout = 10
+pinned_images = {}
+timings = []
+phases = {}
+api_slots = None
+pods_watch_selector = None
+watched_pods = None
+watched_pods_changed = threading.Condition()
+deployment_start = time.time()
+
+# Node properties describing a deployed node rather than its definition, carried over from a
+# previous output file for the nodes an update leaves untouched
+node_runtime_keys = [ 'uuid', 'spec_hash', 'podname', 'servicename', 'clusteripname', 'ports', 'clusterip', 'clusterip_ports',
+                      'podip', 'host', 'status', 'neighbors_added', 'tanglescope_podname', 'tanglescope_clusteripname',
+                      'tanglescope_clusterip', 'tanglescope_clusterip_ports' ]
+
+if __name__ == '__main__':
+    try:
+        opts = getopt(sys.argv[1:], 'i:t:k:c:n:o:x:e:u:p:r:T:L:l:zb:PW:d', ['image=', 'tag=', 'kubeconfig=', 'cluster=', 'namespace=', 'output=', 'ixis=', 'extras=', 'update=', 'parallelism=', 'retries=', 'trace=', 'logs=', 'log-limit=', 'compress-logs', 'batch=', 'prepull', 'prepull-timeout=', 'debug'])
+        parse_opts(opts[0])
+    except:
+        usage()
+
+    if batch is not None:
+        deployments = load_batch(batch)
+    else:
+        deployments = [ load_deployment(tag, docker_image, cluster, output, previous, trace, logs_path) ]
+
+    ixi_cache_dir = mkdtemp(prefix = 'tiab-ixis-')
+    atexit.register(shutil.rmtree, ixi_cache_dir, True)
+
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    print_message("Initializing kubernetes client library against cluster")
+    kubernetes_client = init_k8s_client()
+    templates = init_templates()
+    # One budget of concurrent API calls, shared by all the deployments of a batch
+    api_slots = threading.BoundedSemaphore(parallelism)
+
+    if batch is None:
+        sys.exit(0 if run_deployment(deployments[0]) else 2)
     else:
-        fail(output, cluster)
+        pods_watch_selector = 'tag in (%s)' % ','.join(deployment['tag'] for deployment in deployments)
+        watch_thread = threading.Thread(target = watch_pods, args = (kubernetes_client, pods_watch_selector))
+        watch_thread.daemon = True
+        watch_thread.start()
+        print_message("Deploying %d clusters, up to %d API calls at a time" % (len(deployments), parallelism))
+        pool = ThreadPool(len(deployments))
+        healthy = all(pool.map(run_deployment, deployments, chunksize = 1))
+        pool.close()
+        pool.join()
+        sys.exit(0 if healthy else 2)
@@ -0,0 +1,737 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import re
+import sys
+import json
+import time
+import heapq
+import base64
+import socket
+import struct
+import random
+import hashlib
+import tarfile
+import threading
+from io import BytesIO
+from uuid import uuid4
+from getopt import getopt
+from datetime import datetime
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+# Local stand-ins for the Kubernetes API and the IRI HTTP API, to exercise the TIAB tools without a real
+# cluster. Only the parts of the APIs the tools use are implemented, with configurable latency and failures.
+
+resource_path_regex = re.compile('^/(?:api|apis/[^/]+)/v1/namespaces/([^/]+)/([^/]+)(?:/([^/]+)(?:/([^/]+))?)?$')
+
+def die(s):
+    print(s, file = sys.stderr)
+    sys.exit(2)
+
+def usage():
+    die('''     %s -k kube.config [-l latency] [-s startup-delay] [-T termination-delay] [-f failure-rate] [-F pod-failure-rate] [-I iri-failure-rate] [-X kinds]
+
+                # -k / --kubeconfig         Path of the kubectl config file to write for the fake Kubernetes API
+                # -l / --latency            Seconds of latency added to every API call, defaults to 0
+                # -s / --startup-delay      Mean seconds for a pod to become ready, defaults to 1
+                # -T / --termination-delay  Mean seconds a deleted pod stays Terminating, defaults to 0
+                # -f / --failure-rate       Fraction of API calls failing with a 500 or 429 error, half of the failed creates still creating, defaults to 0
+                # -F / --pod-failure-rate   Fraction of pods failing on startup, defaults to 0
+                # -I / --iri-failure-rate   Fraction of IRI API calls failing with a 500 error, defaults to 0
+                # -X / --forbidden          Comma separated resource kinds whose API calls fail with a 403 error, e.g. roles,rolebindings
+        ''' % __file__)
+
+def timestamp(t = None):
+    return datetime.utcfromtimestamp(t if t is not None else time.time()).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def random_trytes(length):
+    return ''.join(random.choice('9ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(length))
+
+def timestamp_trytes(t):
+    # Balanced ternary, least significant trit first, as IRI encodes integers in transactions
+    (value, trits) = (int(t), [])
+    for _ in range(27):
+        trit = value % 3
+        trit = -1 if trit == 2 else trit
+        trits.append(trit)
+        value = (value - trit) // 3
+    return ''.join('9ABCDEFGHIJKLMNOPQRSTUVWXYZ'[(trits[i] + 3 * trits[i + 1] + 9 * trits[i + 2]) % 27] for i in range(0, 27, 3))
+
+def match_labels(labels, label_selector):
+    # Supports the equality (a=b, a!=b) and set (a in (b,c)) based requirements TIAB uses
+    if not label_selector:
+        return True
+    for requirement in re.findall('[^,(]+(?:\\([^)]*\\))?', label_selector):
+        requirement = requirement.strip()
+        m = re.match('^([^ ]+) in \\(([^)]*)\\)$', requirement)
+        if m:
+            if labels.get(m.group(1)) not in [ value.strip() for value in m.group(2).split(',') ]:
+                return False
+            continue
+        m = re.match('^([^!=]+)(!=|==|=)(.*)$', requirement)
+        if m:
+            if (labels.get(m.group(1)) == m.group(3)) != (m.group(2) != '!='):
+                return False
+            continue
+        if requirement not in labels:
+            return False
+    return True
+
+def match_fields(resource, field_selector):
+    if not field_selector:
+        return True
+    for requirement in field_selector.split(','):
+        (path, value) = requirement.split('=', 1)
+        field = resource
+        for key in path.split('.'):
+            field = field.get(key, {}) if isinstance(field, dict) else {}
+        if field != value:
+            return False
+    return True
+
+def websocket_frame(opcode, data):
+    # Frames sent by a server are not masked
+    header = bytearray([ 0x80 | opcode ])
+    if len(data) < 126:
+        header.append(len(data))
+    elif len(data) < 65536:
+        header += bytearray([ 126 ]) + struct.pack('>H', len(data))
+    else:
+        header += bytearray([ 127 ]) + struct.pack('>Q', len(data))
+    return bytes(header) + data
+
+def read_websocket_frame(stream):
+    header = bytearray(stream.read(2))
+    if len(header) < 2:
+        raise EOFError('websocket closed')
+    length = header[1] & 0x7f
+    if length == 126:
+        length = struct.unpack('>H', stream.read(2))[0]
+    elif length == 127:
+        length = struct.unpack('>Q', stream.read(8))[0]
+    mask = bytearray(stream.read(4)) if header[1] & 0x80 else None
+    data = bytearray(stream.read(length))
+    if mask:
+        for i in range(len(data)):
+            data[i] ^= mask[i % 4]
+    return (header[0] & 0x0f, bytes(data))
+
+class ApiError(Exception):
+
+    def __init__(self, status, reason, message = ''):
+        Exception.__init__(self, message)
+        self.status = status
+        self.reason = reason
+
+    def body(self):
+        return { 'kind': 'Status', 'apiVersion': 'v1', 'metadata': {}, 'status': 'Failure',
+                 'message': str(self), 'reason': self.reason, 'code': self.status }
+
+class FakeKubernetes(object):
+
+    def __init__(self, latency = 0, startup_delay = 1, termination_delay = 0, failure_rate = 0, pod_failure_rate = 0, iri_port = None):
+        self.latency = latency
+        self.startup_delay = startup_delay
+        self.termination_delay = termination_delay
+        self.failure_rate = failure_rate
+        self.pod_failure_rate = pod_failure_rate
+        self.iri_port = iri_port
+        self.resources = {}
+        self.history = []
+        self.resource_version = 0
+        self.calls = {}
+        self.timers = []
+        self.pods_times = {}
+        self.pulled_images = set()
+        # Names of the files extracted by IXI uploads, by namespace and pod name
+        self.uploads = {}
+        # Resource kinds the client is not allowed to access, as with a service account lacking RBAC rights
+        self.forbidden_kinds = set()
+        self.next_port = 30000
+        self.next_ip = 1
+        self.condition = threading.Condition()
+        scheduler = threading.Thread(target = self.run_timers)
+        scheduler.daemon = True
+        scheduler.start()
+
+    def count_call(self, method, kind):
+        with self.condition:
+            key = '%s %s' % (method, kind)
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def call_counts(self):
+        with self.condition:
+            return dict(self.calls)
+
+    def record(self, event_type, kind, namespace, resource):
+        # Must be called with the condition held
+        self.resource_version += 1
+        resource['metadata']['resourceVersion'] = str(self.resource_version)
+        self.history.append((self.resource_version, event_type, kind, namespace, json.loads(json.dumps(resource))))
+        self.condition.notify_all()
+
+    def schedule(self, delay, function, *args):
+        with self.condition:
+            heapq.heappush(self.timers, (time.time() + delay, random.random(), function, args))
+            self.condition.notify_all()
+
+    def run_timers(self):
+        while True:
+            with self.condition:
+                while not self.timers or self.timers[0][0] > time.time():
+                    self.condition.wait(self.timers[0][0] - time.time() if self.timers else None)
+                (_, _, function, args) = heapq.heappop(self.timers)
+            function(*args)
+
+    def allocate_ip(self, prefix):
+        with self.condition:
+            self.next_ip += 1
+            return '%s.%d.%d' % (prefix, self.next_ip // 250 % 250, self.next_ip % 250 + 1)
+
+    def allocate_port(self):
+        with self.condition:
+            self.next_port += 1
+            return self.next_port
+
+    def create(self, kind, namespace, resource):
+        name = resource['metadata'].get('name')
+        if not name:
+            raise ApiError(422, 'Invalid', 'metadata.name is required')
+        now = timestamp()
+        resource['metadata'].update({ 'namespace': namespace, 'uid': str(uuid4()), 'creationTimestamp': now })
+        if kind == 'pods':
+            resource['status'] = { 'phase': 'Pending', 'startTime': now }
+        elif kind == 'daemonsets':
+            # A single node, which runs the daemon set pod once it has pulled its images
+            resource['metadata']['generation'] = 1
+            resource['status'] = { 'currentNumberScheduled': 1, 'desiredNumberScheduled': 1, 'numberMisscheduled': 0, 'numberReady': 0 }
+        elif kind == 'services':
+            resource['spec']['clusterIP'] = self.allocate_ip('10.96')
+            for port in resource['spec'].get('ports', []):
+                if resource['spec'].get('type') == 'NodePort':
+                    # IRI API and Grafana ports are all served by the fake IRI
+                    fake_port = port.get('name') == 'api' or resource['metadata'].get('labels', {}).get('app') == 'prometheus-grafana'
+                    port['nodePort'] = self.iri_port if fake_port and self.iri_port else self.allocate_port()
+                port.setdefault('protocol', 'TCP')
+        with self.condition:
+            resources = self.resources.setdefault(kind, {}).setdefault(namespace, {})
+            if name in resources:
+                raise ApiError(409, 'AlreadyExists', '%s "%s" already exists' % (kind, name))
+            resources[name] = resource
+            self.record('ADDED', kind, namespace, resource)
+        if kind == 'pods':
+            self.pods_times[(namespace, name)] = (time.time(), None)
+            # Half of the startup delay is pulling the image, skipped when it is already on the node
+            startup_delay = self.startup_delay / 2.0 if self.images_present(resource) else self.startup_delay
+            self.schedule(random.expovariate(1.0 / startup_delay) if startup_delay else 0, self.start_pod, namespace, name)
+        elif kind == 'daemonsets':
+            self.schedule(random.expovariate(2.0 / self.startup_delay) if self.startup_delay else 0, self.start_daemon_set, namespace, name)
+        return resource
+
+    def images_present(self, pod):
+        with self.condition:
+            containers = pod['spec'].get('initContainers', []) + pod['spec']['containers']
+            return all(container.get('imagePullPolicy') == 'IfNotPresent' and container['image'] in self.pulled_images for container in containers)
+
+    def start_daemon_set(self, namespace, name):
+        with self.condition:
+            daemon_set = self.resources.get('daemonsets', {}).get(namespace, {}).get(name)
+            if daemon_set is None:
+                return
+            pod_spec = daemon_set['spec']['template']['spec']
+            self.pulled_images.update(container['image'] for container in pod_spec.get('initContainers', []) + pod_spec['containers'])
+            daemon_set['status'].update({ 'numberReady': 1, 'numberAvailable': 1, 'updatedNumberScheduled': 1,
+                                          'observedGeneration': daemon_set['metadata']['generation'] })
+            self.record('MODIFIED', 'daemonsets', namespace, daemon_set)
+
+    def start_pod(self, namespace, name):
+        with self.condition:
+            pod = self.resources.get('pods', {}).get(namespace, {}).get(name)
+            if pod is None:
+                return
+            # The startup delay is split between pulling the image and running the entrypoint
+            (created, _) = self.pods_times.get((namespace, name), (time.time(), None))
+            started = time.time()
+            cached = self.images_present(pod)
+            pulled = created if cached else created + (started - created) / 2
+            self.pods_times[(namespace, name)] = (created, started)
+            now = timestamp(started)
+            failed = random.random() < self.pod_failure_rate
+            pod['spec']['nodeName'] = '127.0.0.1'
+            pod['status'].update({
+                'phase': 'Failed' if failed else 'Running',
+                'podIP': self.allocate_ip('10.244'),
+                'hostIP': '127.0.0.1',
+                'conditions': [ { 'type': condition, 'status': 'False' if failed and condition != 'PodScheduled' else 'True',
+                                  'lastTransitionTime': now } for condition in [ 'PodScheduled', 'Initialized', 'ContainersReady', 'Ready' ] ],
+                'containerStatuses': [ { 'name': container['name'], 'image': container['image'], 'imageID': 'docker-pullable://%s' % container['image'],
+                                         'ready': not failed, 'restartCount': 0,
+                                         'state': { 'terminated': { 'exitCode': 1, 'startedAt': now, 'finishedAt': now } } if failed
+                                                  else { 'running': { 'startedAt': now } } }
+                                       for container in pod['spec']['containers'] ]
+            })
+            self.record('MODIFIED', 'pods', namespace, pod)
+            for (reason, at) in [ ('Scheduled', created) ] + ([] if cached else [ ('Pulling', created) ]) \
+                                 + [ ('Pulled', pulled), ('Created', pulled), ('Started', pulled) ]:
+                event_name = '%s.%s' % (name, uuid4().hex[:16])
+                event = { 'metadata': { 'name': event_name, 'namespace': namespace, 'creationTimestamp': timestamp(at) },
+                          'involvedObject': { 'kind': 'Pod', 'name': name, 'namespace': namespace },
+                          'reason': reason, 'message': reason, 'type': 'Normal', 'count': 1,
+                          'firstTimestamp': timestamp(at), 'lastTimestamp': timestamp(at) }
+                self.resources.setdefault('events', {}).setdefault(namespace, {})[event_name] = event
+                self.record('ADDED', 'events', namespace, event)
+
+    def get(self, kind, namespace, name):
+        with self.condition:
+            resource = self.resources.get(kind, {}).get(namespace, {}).get(name)
+            if resource is None:
+                raise ApiError(404, 'NotFound', '%s "%s" not found' % (kind, name))
+            return resource
+
+    def replace(self, kind, namespace, name, resource):
+        with self.condition:
+            current = self.get(kind, namespace, name)
+            resource['metadata'].update({ key: current['metadata'][key] for key in [ 'namespace', 'uid', 'creationTimestamp' ] })
+            if 'status' in current:
+                resource['status'] = current['status']
+            if kind == 'daemonsets':
+                # The new generation rolls out to the node again, while the status still reports the previous one
+                resource['metadata']['generation'] = current['metadata'].get('generation', 1) + 1
+                resource['status'] = dict(current['status'], updatedNumberScheduled = 0)
+            self.resources[kind][namespace][name] = resource
+            self.record('MODIFIED', kind, namespace, resource)
+        if kind == 'daemonsets':
+            self.schedule(random.expovariate(2.0 / self.startup_delay) if self.startup_delay else 0, self.start_daemon_set, namespace, name)
+        return resource
+
+    def delete(self, kind, namespace, name, grace_period = None):
+        with self.condition:
+            resource = self.get(kind, namespace, name)
+            if kind == 'pods' and self.termination_delay and grace_period != 0:
+                # Pods go through Terminating before they are actually removed
+                if 'deletionTimestamp' not in resource['metadata']:
+                    resource['metadata']['deletionTimestamp'] = timestamp()
+                    self.record('MODIFIED', kind, namespace, resource)
+                    self.schedule(random.expovariate(1.0 / self.termination_delay), self.remove, kind, namespace, name)
+                return resource
+            return self.remove(kind, namespace, name)
+
+    def remove(self, kind, namespace, name):
+        with self.condition:
+            resource = self.resources.get(kind, {}).get(namespace, {}).pop(name, None)
+            if kind == 'pods':
+                self.pods_times.pop((namespace, name), None)
+            if resource is not None:
+                self.record('DELETED', kind, namespace, resource)
+            return resource
+
+    def list(self, kind, namespace, label_selector = None, field_selector = None):
+        with self.condition:
+            items = [ resource for resource in self.resources.get(kind, {}).get(namespace, {}).values()
+                      if match_labels(resource['metadata'].get('labels', {}), label_selector) and match_fields(resource, field_selector) ]
+            return { 'kind': 'List', 'apiVersion': 'v1', 'metadata': { 'resourceVersion': str(self.resource_version) }, 'items': items }
+
+    def watch(self, kind, namespace, resource_version, timeout, label_selector = None, field_selector = None):
+        # Yields the matching events recorded after resource_version, until timeout
+        deadline = time.time() + timeout
+        position = 0
+        while True:
+            with self.condition:
+                while position < len(self.history) and self.history[position][0] <= resource_version:
+                    position += 1
+                events = self.history[position:]
+                position = len(self.history)
+                if not events:
+                    if time.time() >= deadline:
+                        return
+                    self.condition.wait(min(1, deadline - time.time()))
+                    continue
+            for (version, event_type, event_kind, event_namespace, resource) in events:
+                if event_kind == kind and event_namespace == namespace \
+                   and match_labels(resource['metadata'].get('labels', {}), label_selector) and match_fields(resource, field_selector):
+                    yield { 'type': event_type, 'object': resource }
+
+    def log(self, namespace, name, tail_lines = None, limit_bytes = None, container = None):
+        pod = self.get('pods', namespace, name)
+        containers = [ e['name'] for e in pod['spec']['containers'] ]
+        if container is None and len(containers) > 1:
+            raise ApiError(400, 'BadRequest', 'a container name must be specified for pod %s, choose one of: [%s]' % (name, ' '.join(containers)))
+        if container is not None and container not in containers:
+            raise ApiError(400, 'BadRequest', 'container %s is not valid for pod %s' % (container, name))
+        lines = []
+        (created, started) = self.pods_times.get((namespace, name), (None, None))
+        if started is not None:
+            # Timing markers as printed by tiab-entrypoint.sh
+            pulled = created + (started - created) / 2
+            lines += [ 'TIAB_TIMING db_download start %.9f' % pulled, 'TIAB_TIMING db_download end %.9f' % started ]
+        lines += [ '%s INFO  com.iota.iri.IRI - fake log line %d of pod %s' % (timestamp(), line, name) for line in range(0, 100) ]
+        if pod['status'].get('phase') == 'Failed':
+            lines.append('ERROR: pod %s failed to start' % name)
+        if tail_lines is not None:
+            lines = lines[-tail_lines:] if tail_lines > 0 else []
+        text = ''.join([ line + '\n' for line in lines ])
+        return text[:limit_bytes] if limit_bytes is not None else text
+
+    def exec_command(self, namespace, name, command, read_stdin):
+        # Runs the commands create_cluster.py runs in IRI pods, returning the exit code and the error output
+        if command[:2] == [ 'mkdir', '-p' ]:
+            return (0, '')
+        m = re.match('^head -c ([0-9]+) \\| tar zxf - -C ', command[2]) if command[:2] == [ 'sh', '-c' ] and len(command) == 3 else None
+        if not m:
+            return (127, 'sh: %s: not found\n' % ' '.join(command))
+        data = read_stdin(int(m.group(1)))
+        try:
+            with tarfile.open(fileobj = BytesIO(data), mode = 'r:gz') as archive:
+                names = archive.getnames()
+        except (tarfile.TarError, IOError, EOFError) as e:
+            return (2, 'tar: %s\n' % e)
+        with self.condition:
+            self.uploads.setdefault((namespace, name), []).extend(names)
+        return (0, '')
+
+class KubernetesRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_text(self, status, text):
+        data = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8')) if length else None
+
+    def handle_request(self, method):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        query = { key: values[0] for (key, values) in parse_qs(url.query).items() }
+        body = self.read_body() if method in ('POST', 'PUT', 'DELETE') else None
+        if url.path == '/fake/calls':
+            return self.send_json(200, fake.call_counts())
+        m = resource_path_regex.match(url.path)
+        if not m:
+            return self.send_json(404, ApiError(404, 'NotFound', 'unsupported path %s' % url.path).body())
+        (namespace, kind, name, subresource) = m.groups()
+        fake.count_call(method, kind if not subresource else '%s/%s' % (kind, subresource))
+        if fake.latency:
+            time.sleep(fake.latency)
+        if kind in fake.forbidden_kinds:
+            return self.send_json(403, ApiError(403, 'Forbidden', '%s is forbidden' % kind).body())
+        if fake.failure_rate and random.random() < fake.failure_rate:
+            status = random.choice([ 429, 500 ])
+            if status == 500 and method == 'POST' and name is None and random.random() < 0.5:
+                # The resource is created but the response is lost, as when the API server times out
+                try:
+                    fake.create(kind, namespace, body)
+                except ApiError:
+                    pass
+            return self.send_json(status, ApiError(status, 'TooManyRequests' if status == 429 else 'InternalError', 'injected failure').body())
+        try:
+            if name is None and method == 'GET' and query.get('watch', '').lower() == 'true':
+                return self.stream_watch(fake, kind, namespace, query)
+            elif name is None and method == 'GET':
+                result = fake.list(kind, namespace, query.get('labelSelector'), query.get('fieldSelector'))
+            elif name is None and method == 'POST':
+                result = fake.create(kind, namespace, body)
+            elif name is None and method == 'DELETE':
+                items = fake.list(kind, namespace, query.get('labelSelector'), query.get('fieldSelector'))['items']
+                for item in items:
+                    fake.delete(kind, namespace, item['metadata']['name'])
+                result = { 'kind': 'Status', 'apiVersion': 'v1', 'metadata': {}, 'status': 'Success' }
+            elif subresource == 'exec' and method == 'GET':
+                return self.stream_exec(fake, namespace, name, parse_qs(url.query).get('command', []))
+            elif subresource == 'log' and method == 'GET':
+                return self.send_text(200, fake.log(namespace, name,
+                                                    int(query['tailLines']) if 'tailLines' in query else None,
+                                                    int(query['limitBytes']) if 'limitBytes' in query else None,
+                                                    query.get('container')))
+            elif subresource is None and method == 'GET':
+                result = fake.get(kind, namespace, name)
+            elif subresource is None and method == 'PUT':
+                result = fake.replace(kind, namespace, name, body)
+            elif subresource is None and method == 'DELETE':
+                grace_period = query.get('gracePeriodSeconds', (body or {}).get('gracePeriodSeconds'))
+                fake.delete(kind, namespace, name, int(grace_period) if grace_period is not None else None)
+                result = { 'kind': 'Status', 'apiVersion': 'v1', 'metadata': {}, 'status': 'Success' }
+            else:
+                raise ApiError(405, 'MethodNotAllowed', '%s %s is not supported' % (method, url.path))
+        except ApiError as e:
+            return self.send_json(e.status, e.body())
+        self.send_json(201 if method == 'POST' else 200, result)
+
+    def stream_watch(self, fake, kind, namespace, query):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        resource_version = int(query.get('resourceVersion') or 0)
+        try:
+            for event in fake.watch(kind, namespace, resource_version, int(query.get('timeoutSeconds', 300)),
+                                    query.get('labelSelector'), query.get('fieldSelector')):
+                data = (json.dumps(event) + '\n').encode('utf-8')
+                self.wfile.write(('%x\r\n' % len(data)).encode('ascii') + data + b'\r\n')
+                self.wfile.flush()
+            self.wfile.write(b'0\r\n\r\n')
+        except (IOError, socket.error):
+            # The client stopped watching
+            self.close_connection = True
+
+    def stream_exec(self, fake, namespace, name, command):
+        # Exec over a websocket with the v4.channel.k8s.io protocol: every frame starts with its channel,
+        # 0 for stdin, 1 and 2 for stdout and stderr, and 3 for the exit status sent before closing
+        pod = fake.get('pods', namespace, name)
+        if pod['status'].get('phase') != 'Running':
+            raise ApiError(400, 'BadRequest', 'pod %s is not running' % name)
+        key = self.headers.get('Sec-WebSocket-Key', '') + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', base64.b64encode(hashlib.sha1(key.encode('ascii')).digest()).decode('ascii'))
+        self.send_header('Sec-WebSocket-Protocol', 'v4.channel.k8s.io')
+        self.end_headers()
+        self.close_connection = True
+
+        def read_stdin(size):
+            data = b''
+            while len(data) < size:
+                (opcode, frame) = read_websocket_frame(self.rfile)
+                if opcode == 8:
+                    break
+                if frame[:1] == b'\x00':
+                    data += frame[1:]
+            return data[:size]
+
+        try:
+            (code, error) = fake.exec_command(namespace, name, command, read_stdin)
+            if error:
+                self.wfile.write(websocket_frame(2, b'\x02' + error.encode('utf-8')))
+            if code == 0:
+                status = { 'metadata': {}, 'status': 'Success' }
+            else:
+                status = { 'metadata': {}, 'status': 'Failure', 'reason': 'NonZeroExitCode',
+                           'message': 'command terminated with non-zero exit code: exit status %d' % code,
+                           'details': { 'causes': [ { 'reason': 'ExitCode', 'message': str(code) } ] } }
+            self.wfile.write(websocket_frame(2, b'\x03' + json.dumps(status).encode('utf-8')))
+            self.wfile.write(websocket_frame(8, struct.pack('>H', 1000)))
+            self.wfile.flush()
+        except (EOFError, IOError, socket.error):
+            # The client closed the connection
+            pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+class FakeIRI(object):
+
+    def __init__(self, latency = 0, failure_rate = 0, confirmation_delay = 2, milestone_interval = 10):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.confirmation_delay = confirmation_delay
+        self.milestone_interval = milestone_interval
+        self.started = time.time()
+        self.calls = {}
+        # Stored transactions by hash, as (tag, time stored), confirmed once confirmation_delay has elapsed
+        self.transactions = {}
+        self.lock = threading.Lock()
+
+    def call_counts(self):
+        with self.lock:
+            return dict(self.calls)
+
+    def call(self, request):
+        with self.lock:
+            self.calls[request['command']] = self.calls.get(request['command'], 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise ApiError(500, 'InternalError', 'injected failure')
+        if request['command'] == 'getNodeInfo':
+            milestone = int((time.time() - self.started) / self.milestone_interval)
+            return { 'appName': 'IRI Testnet', 'appVersion': 'fake', 'latestMilestoneIndex': milestone, 'latestSolidSubtangleMilestoneIndex': milestone,
+                     'latestSolidSubtangleMilestone': '9' * 81, 'neighbors': 2, 'tips': 0, 'time': int(time.time() * 1000), 'duration': 0 }
+        elif request['command'] == 'getNeighbors':
+            # All the nodes share this stand-in, so they all report the same two neighbors, receiving a transaction per second
+            received = int(time.time() - self.started)
+            return { 'neighbors': [ { 'address': 'neighbor%d:14600' % index, 'connectionType': 'udp', 'numberOfAllTransactions': received,
+                                      'numberOfNewTransactions': received, 'numberOfInvalidTransactions': 0, 'numberOfRandomTransactionRequests': 0,
+                                      'numberOfSentTransactions': received } for index in range(0, 2) ], 'duration': 0 }
+        elif request['command'] == 'addNeighbors':
+            return { 'addedNeighbors': len(request.get('uris', [])), 'duration': 0 }
+        elif request['command'] == 'removeNeighbors':
+            return { 'removedNeighbors': len(request.get('uris', [])), 'duration': 0 }
+        elif request['command'] == 'getTransactionsToApprove':
+            return { 'trunkTransaction': random_trytes(81), 'branchTransaction': random_trytes(81), 'duration': 0 }
+        elif request['command'] == 'attachToTangle':
+            # Fills in trunk, branch, attachment timestamps and nonce, without doing any proof of work
+            trytes = [ transaction[:2430] + request['trunkTransaction'] + request['branchTransaction'] + transaction[2592:2619] +
+                       timestamp_trytes(time.time() * 1000) + '9' * 9 + 'M' * 9 + random_trytes(27) for transaction in request['trytes'] ]
+            return { 'trytes': trytes, 'duration': 0 }
+        elif request['command'] == 'storeTransactions':
+            with self.lock:
+                for transaction in request['trytes']:
+                    self.transactions[random_trytes(81)] = (transaction[2592:2619], time.time())
+            return { 'duration': 0 }
+        elif request['command'] == 'broadcastTransactions':
+            return { 'duration': 0 }
+        elif request['command'] == 'getTips':
+            with self.lock:
+                return { 'hashes': list(self.transactions.keys())[-100:], 'duration': 0 }
+        elif request['command'] == 'findTransactions':
+            tags = set(tag.ljust(27, '9') for tag in request.get('tags', []))
+            with self.lock:
+                return { 'hashes': [ h for (h, (tag, _)) in self.transactions.items() if tag in tags ], 'duration': 0 }
+        elif request['command'] == 'getInclusionStates':
+            confirmed_before = time.time() - self.confirmation_delay
+            with self.lock:
+                return { 'states': [ h in self.transactions and self.transactions[h][1] <= confirmed_before
+                                     for h in request['transactions'] ], 'duration': 0 }
+        elif request['command'] == 'grafanaDatasource':
+            return { 'id': 1, 'message': 'Datasource added', 'name': 'Prometheus' }
+        raise ApiError(400, 'BadRequest', 'Command [%s] is unknown' % request['command'])
+
+class IRIRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which Nagle's algorithm would delay on kept-alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            if self.path.startswith('/api/datasources'):
+                # Grafana datasource registration done by create_cluster.py for monitoring
+                request = { 'command': 'grafanaDatasource' }
+            (status, body) = (200, self.server.fake.call(request))
+        except ApiError as e:
+            (status, body) = (e.status, { 'error': str(e), 'duration': 0 })
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+def start_server(handler, fake, port = 0):
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.fake = fake
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def write_kubeconfig(path, port):
+    with open(path, 'w') as stream:
+        json.dump({
+                    'apiVersion': 'v1',
+                    'kind': 'Config',
+                    'clusters': [ { 'name': 'fake', 'cluster': { 'server': 'http://127.0.0.1:%d' % port } } ],
+                    'users': [ { 'name': 'fake', 'user': { 'token': 'fake' } } ],
+                    'contexts': [ { 'name': 'fake', 'context': { 'cluster': 'fake', 'user': 'fake', 'namespace': 'default' } } ],
+                    'current-context': 'fake'
+                  }, stream, indent = 2)
+
+def start_fake_cluster(kubeconfig, latency = 0, startup_delay = 1, termination_delay = 0, failure_rate = 0, pod_failure_rate = 0, iri_failure_rate = 0):
+    iri = FakeIRI(latency = latency, failure_rate = iri_failure_rate)
+    iri_server = start_server(IRIRequestHandler, iri)
+    kubernetes = FakeKubernetes(latency = latency, startup_delay = startup_delay, termination_delay = termination_delay,
+                                failure_rate = failure_rate,
+                                pod_failure_rate = pod_failure_rate, iri_port = iri_server.server_address[1])
+    kubernetes_server = start_server(KubernetesRequestHandler, kubernetes)
+    write_kubeconfig(kubeconfig, kubernetes_server.server_address[1])
+    return (kubernetes, iri)
+
+def start_fake_nodes(count, latency = 0):
+    # Nodes of a cluster output file, all served by one fake IRI API, for the tools talking to IRI only
+    iri_server = start_server(IRIRequestHandler, FakeIRI(latency = latency))
+    port = iri_server.server_address[1]
+    return { 'node%d' % index: { 'host': '127.0.0.1', 'ports': { 'api': port }, 'status': 'Running' } for index in range(0, count) }
+
+def parse_opts(opts):
+    global kubeconfig, latency, startup_delay, termination_delay, failure_rate, pod_failure_rate, iri_failure_rate, forbidden_kinds
+    for (key, value) in opts:
+        if key == '-k' or key == '--kubeconfig':
+            kubeconfig = value
+        elif key == '-l' or key == '--latency':
+            latency = float(value)
+        elif key == '-s' or key == '--startup-delay':
+            startup_delay = float(value)
+        elif key == '-T' or key == '--termination-delay':
+            termination_delay = float(value)
+        elif key == '-f' or key == '--failure-rate':
+            failure_rate = float(value)
+        elif key == '-F' or key == '--pod-failure-rate':
+            pod_failure_rate = float(value)
+        elif key == '-I' or key == '--iri-failure-rate':
+            iri_failure_rate = float(value)
+        elif key == '-X' or key == '--forbidden':
+            forbidden_kinds = set(value.split(','))
+        else:
+            usage()
+    if not kubeconfig:
+        usage()
+
+kubeconfig = None
+latency = 0
+startup_delay = 1
+termination_delay = 0
+failure_rate = 0
+pod_failure_rate = 0
+iri_failure_rate = 0
+forbidden_kinds = set()
+
+if __name__ == '__main__':
+    try:
+        opts = getopt(sys.argv[1:], 'k:l:s:T:f:F:I:X:', ['kubeconfig=', 'latency=', 'startup-delay=', 'termination-delay=', 'failure-rate=', 'pod-failure-rate=', 'iri-failure-rate=', 'forbidden='])
+        parse_opts(opts[0])
+    except:
+        usage()
+
+    (fake_kubernetes, _) = start_fake_cluster(kubeconfig, latency, startup_delay, termination_delay, failure_rate, pod_failure_rate, iri_failure_rate)
+    fake_kubernetes.forbidden_kinds = forbidden_kinds
+    print('Fake Kubernetes API running, kubeconfig written to %s' % kubeconfig)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
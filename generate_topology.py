@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import sys
+import copy
+import yaml
+import random
+from getopt import getopt
+
+# Generates the nodes and neighbors of a cluster definition from its topology section, e.g.
+#
+# topology:
+#   kind: small-world
+#   nodes: 500
+#   degree: 4
+#   node:
+#     db: https://...
+#
+# create_cluster.py expands the topology by itself, this script only shows the expanded definition.
+
+gossip_ports = { 'tcp': 15600, 'udp': 14600 }
+
+def die(s):
+    print(s, file = sys.stderr)
+    sys.exit(2)
+
+def usage():
+    die('''     %s -c cluster.yml [-o expanded.yml]
+
+                # -c / --cluster            cluster definition in YAML format, with a topology section
+                # -o / --output             output file for the expanded cluster definition, defaults to stdout
+        ''' % __file__)
+
+def edge(a, b):
+    return (a, b) if a < b else (b, a)
+
+def k_regular_edges(size, degree, rng):
+    # Every node gets exactly degree neighbors: the neighbor slots are paired at random, then the few
+    # self-links and duplicate links this leaves are removed by swapping their ends with other links
+    if degree < 1 or degree >= size or size * degree % 2:
+        raise ValueError('a k-regular topology needs 0 < degree < nodes, and an even nodes * degree')
+    if degree == size - 1:
+        return set(edge(a, b) for a in range(size) for b in range(a))
+    for _ in range(10):
+        edges = random_regular_edges(size, degree, rng)
+        if edges is not None:
+            return edges
+    raise ValueError('could not generate a %d-regular topology of %d nodes' % (degree, size))
+
+def random_regular_edges(size, degree, rng):
+    slots = [ node for node in range(size) for _ in range(degree) ]
+    rng.shuffle(slots)
+    edges = set()
+    invalid = []
+    for i in range(0, len(slots), 2):
+        pair = edge(slots[i], slots[i + 1])
+        if pair[0] == pair[1] or pair in edges:
+            invalid.append(pair)
+        else:
+            edges.add(pair)
+    # Links picked for a swap come from a list, where swapped links stay until they are picked again
+    candidates = sorted(edges)
+    attempts = 100 * len(slots)
+    while invalid and attempts:
+        attempts -= 1
+        (a, b) = invalid[-1]
+        (c, d) = rng.choice(candidates)
+        if (c, d) not in edges:
+            continue
+        if rng.random() < 0.5:
+            (c, d) = (d, c)
+        swapped = [ edge(a, c), edge(b, d) ]
+        if a != c and b != d and swapped[0] != swapped[1] and swapped[0] not in edges and swapped[1] not in edges:
+            edges.remove(edge(c, d))
+            edges.update(swapped)
+            candidates += swapped
+            invalid.pop()
+    return edges if not invalid else None
+
+def small_world_edges(size, degree, rewire, rng):
+    # Watts-Strogatz: a ring where every node links to its degree nearest nodes, whose links are then
+    # moved to a random node with probability rewire, giving short paths across the ring
+    if degree < 2 or degree % 2 or degree >= size or not 0 <= rewire <= 1:
+        raise ValueError('a small-world topology needs an even degree, 0 < degree < nodes, and 0 <= rewire <= 1')
+    edges = set(edge(node, (node + step) % size) for step in range(1, degree // 2 + 1) for node in range(size))
+    for (a, b) in sorted(edges):
+        if rng.random() < rewire:
+            for _ in range(size):
+                target = rng.randrange(size)
+                if target != a and edge(a, target) not in edges:
+                    edges.remove(edge(a, b))
+                    edges.add(edge(a, target))
+                    break
+    return edges
+
+def scale_free_edges(size, degree, rng):
+    # Barabasi-Albert: starting from degree + 1 linked nodes, every new node links to degree existing
+    # nodes picked with a probability proportional to their number of neighbors, which makes a few hubs
+    if degree < 1 or degree >= size:
+        raise ValueError('a scale-free topology needs 0 < degree < nodes')
+    edges = set(edge(a, b) for a in range(degree + 1) for b in range(a))
+    ends = [ node for pair in edges for node in pair ]
+    for node in range(degree + 1, size):
+        targets = set()
+        while len(targets) < degree:
+            targets.add(rng.choice(ends))
+        for target in targets:
+            edges.add(edge(target, node))
+            ends += [ target, node ]
+    return edges
+
+def expand_topology(cluster):
+    # Adds the generated nodes to the cluster definition. Properties of a generated node can be
+    # overridden under nodes, whose own neighbors are kept after the generated ones.
+    topology = cluster.get('topology') if type(cluster) is dict else None
+    if topology is None:
+        return cluster
+    if type(topology) is not dict:
+        raise ValueError('topology must be a mapping')
+    kind = topology.get('kind')
+    size = topology.get('nodes')
+    degree = topology.get('degree', 4)
+    protocol = topology.get('protocol', 'tcp')
+    prefix = str(topology.get('prefix', 'node'))
+    if type(size) is not int or size < 2 or type(degree) is not int:
+        raise ValueError('topology needs an integer number of nodes, at least 2, and an integer degree')
+    if protocol not in gossip_ports:
+        raise ValueError('unknown topology protocol %s, use one of %s' % (protocol, ', '.join(sorted(gossip_ports))))
+    if type(topology.get('node', {})) is not dict:
+        raise ValueError('the topology node properties must be a mapping')
+    rng = random.Random(topology.get('seed', 0))
+    if kind == 'k-regular':
+        edges = k_regular_edges(size, degree, rng)
+    elif kind == 'small-world':
+        edges = small_world_edges(size, degree, float(topology.get('rewire', 0.1)), rng)
+    elif kind == 'scale-free':
+        edges = scale_free_edges(size, degree, rng)
+    else:
+        raise ValueError('unknown topology kind %s, use one of k-regular, small-world, scale-free' % kind)
+
+    names = [ '%s%0*d' % (prefix, len(str(size - 1)), node) for node in range(size) ]
+    neighbors = [ [] for _ in range(size) ]
+    for (a, b) in sorted(edges):
+        neighbors[a].append(b)
+        neighbors[b].append(a)
+    nodes = cluster.get('nodes') or {}
+    if type(nodes) is not dict:
+        raise ValueError('nodes must be a mapping')
+    for (node, name) in enumerate(names):
+        properties = copy.deepcopy(topology.get('node', {}))
+        properties.update(nodes.get(name) or {})
+        generated = [ '%s://%s:%d' % (protocol, names[neighbor], gossip_ports[protocol]) for neighbor in sorted(neighbors[node]) ]
+        properties['neighbors'] = generated + [ e for e in (nodes.get(name) or {}).get('neighbors', []) if e not in generated ]
+        nodes[name] = properties
+    cluster['nodes'] = nodes
+    return cluster
+
+def describe_topology(cluster):
+    # Links between nodes of the cluster, i.e. not counting neighbors outside of it
+    links = {}
+    for (node, properties) in cluster['nodes'].items():
+        for neighbor in properties.get('neighbors') or []:
+            host = str(neighbor).split('://')[-1].rsplit(':', 1)[0]
+            if host in cluster['nodes']:
+                links.setdefault(node, set()).add(host)
+                links.setdefault(host, set()).add(node)
+    degrees = [ len(links.get(node, [])) for node in cluster['nodes'] ]
+    components = 0
+    seen = set()
+    for node in cluster['nodes']:
+        if node in seen:
+            continue
+        components += 1
+        pending = [ node ]
+        seen.add(node)
+        while pending:
+            for neighbor in links.get(pending.pop(), []):
+                if neighbor not in seen:
+                    seen.add(neighbor)
+                    pending.append(neighbor)
+    return '%d nodes, %d links, %d to %d neighbors per node (%.1f on average), %d connected component%s' % \
+           (len(degrees), sum(degrees) // 2, min(degrees), max(degrees), float(sum(degrees)) / len(degrees), components, '' if components == 1 else 's')
+
+def parse_opts(opts):
+    global cluster, output
+    for (key, value) in opts:
+        if key == '-c' or key == '--cluster':
+            cluster = value
+        elif key == '-o' or key == '--output':
+            output = value
+        else:
+            usage()
+    if not cluster:
+        usage()
+
+cluster = None
+output = None
+
+if __name__ == '__main__':
+    try:
+        opts = getopt(sys.argv[1:], 'c:o:', ['cluster=', 'output='])
+        parse_opts(opts[0])
+    except:
+        usage()
+
+    with open(cluster, 'r') as stream:
+        try:
+            definition = yaml.load(stream, Loader = yaml.SafeLoader)
+        except yaml.YAMLError as e:
+            die(e)
+    if type(definition) is not dict or 'topology' not in definition:
+        die("The cluster definition has no topology section")
+    try:
+        expand_topology(definition)
+    except ValueError as e:
+        die("Invalid topology: %s" % e)
+    print(describe_topology(definition), file = sys.stderr)
+    # The expanded definition has explicit nodes only, and can be edited and deployed as it is
+    definition.pop('topology')
+    expanded = yaml.dump(definition, default_flow_style = False)
+    if output is None:
+        sys.stdout.write(expanded)
+    else:
+        with open(output, 'w') as stream:
+            stream.write(expanded)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import sys
+import json
+import time
+import yaml
+import random
+import binascii
+import requests
+import threading
+import fake_cluster
+from getopt import getopt
+from multiprocessing.pool import ThreadPool
+
+api_headers = {
+                'X-IOTA-API-Version': '1',
+                'Content-Type': 'application/json'
+              }
+
+tryte_alphabet = '9ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+# Keccak-f[1600] parameters, for the Kerl hash of the bundles
+keccak_round_constants = [
+    0x0000000000000001, 0x0000000000008082, 0x800000000000808A, 0x8000000080008000,
+    0x000000000000808B, 0x0000000080000001, 0x8000000080008081, 0x8000000000008009,
+    0x000000000000008A, 0x0000000000000088, 0x0000000080008009, 0x000000008000000A,
+    0x000000008000808B, 0x800000000000008B, 0x8000000000008089, 0x8000000000008003,
+    0x8000000000008002, 0x8000000000000080, 0x000000000000800A, 0x800000008000000A,
+    0x8000000080008081, 0x8000000000008080, 0x0000000080000001, 0x8000000080008008
+]
+keccak_rotations = [ [ 0, 36, 3, 41, 18 ], [ 1, 44, 10, 45, 2 ], [ 62, 6, 43, 15, 61 ], [ 28, 55, 25, 21, 56 ], [ 27, 20, 39, 8, 14 ] ]
+keccak_lane_mask = (1 << 64) - 1
+# Keccak-384 absorbs 104 bytes per permutation
+keccak_rate = 104
+
+def print_message(s):
+    print(s, file = sys.stderr)
+
+def die(s):
+    print(s, file = sys.stderr)
+    sys.exit(2)
+
+def usage():
+    die('''     %s -c output.yml [-d duration] [-r rate] [-w workers] [-a api-command] [-D depth] [-m mwm] [-C confirmation-timeout] [-o results.json]
+     %s -F nodes [-l latency] [-d duration] [-r rate] [-w workers] [-a api-command] [-C confirmation-timeout] [-o results.json]
+
+                # -c / --cluster                Output YAML file of create_cluster.py describing the deployed nodes
+                # -d / --duration               Seconds of load, defaults to 60
+                # -r / --rate                   Transactions or API calls per second sent to each node, defaults to 0 for as fast as possible
+                # -w / --workers                Concurrent requests per node, defaults to 2
+                # -a / --api                    Load the nodes with this API command, e.g. getNodeInfo, instead of sending transactions
+                # -D / --depth                  Depth given to getTransactionsToApprove, defaults to 3
+                # -m / --mwm                    Minimum weight magnitude given to attachToTangle, defaults to 9
+                # -C / --confirmation-timeout   Seconds to wait for the transactions to be confirmed after the load, defaults to 60
+                # -o / --output                 output file for the results in JSON format
+                # -F / --fake                   Run against this number of local IRI stand-ins instead of a deployed cluster
+                # -l / --latency                Seconds of latency added to every call of the local IRI stand-ins, defaults to 0
+        ''' % (__file__, __file__))
+
+def parse_opts(opts):
+    global cluster_file, duration, rate, workers, api_command, depth, mwm, confirmation_timeout, output, fake_nodes, latency
+    if len(opts) == 0:
+        usage()
+    for (key, value) in opts:
+        if key == '-c' or key == '--cluster':
+            cluster_file = value
+        elif key == '-d' or key == '--duration':
+            duration = float(value)
+        elif key == '-r' or key == '--rate':
+            rate = float(value)
+        elif key == '-w' or key == '--workers':
+            workers = int(value)
+        elif key == '-a' or key == '--api':
+            api_command = value
+        elif key == '-D' or key == '--depth':
+            depth = int(value)
+        elif key == '-m' or key == '--mwm':
+            mwm = int(value)
+        elif key == '-C' or key == '--confirmation-timeout':
+            confirmation_timeout = float(value)
+        elif key == '-o' or key == '--output':
+            output = value
+        elif key == '-F' or key == '--fake':
+            fake_nodes = int(value)
+        elif key == '-l' or key == '--latency':
+            latency = float(value)
+        else:
+            usage()
+    if (cluster_file is None) == (fake_nodes is None):
+        usage()
+    if duration <= 0 or rate < 0 or workers < 1 or (fake_nodes is not None and fake_nodes < 1):
+        usage()
+
+def int_to_trits(value, length):
+    # Balanced ternary, least significant trit first
+    trits = []
+    for _ in range(length):
+        trit = value % 3
+        if trit == 2:
+            trit = -1
+        trits.append(trit)
+        value = (value - trit) // 3
+    return trits
+
+def trytes_to_trits(trytes):
+    trits = []
+    for tryte in trytes:
+        value = tryte_alphabet.index(tryte)
+        trits += int_to_trits(value - 27 if value > 13 else value, 3)
+    return trits
+
+def trits_to_trytes(trits):
+    return ''.join(tryte_alphabet[(trits[i] + 3 * trits[i + 1] + 9 * trits[i + 2]) % 27] for i in range(0, len(trits), 3))
+
+def int_to_trytes(value, length):
+    return trits_to_trytes(int_to_trits(value, length * 3))
+
+def random_trytes(length):
+    return ''.join(random.choice(tryte_alphabet) for _ in range(length))
+
+def keccak_permutation(lanes):
+    rotate = lambda lane, n: ((lane << n) | (lane >> (64 - n))) & keccak_lane_mask
+    for round_constant in keccak_round_constants:
+        columns = [ lanes[x] ^ lanes[x + 5] ^ lanes[x + 10] ^ lanes[x + 15] ^ lanes[x + 20] for x in range(5) ]
+        lanes = [ lanes[i] ^ columns[(i - 1) % 5] ^ rotate(columns[(i + 1) % 5], 1) for i in range(25) ]
+        rotated = [ 0 ] * 25
+        for x in range(5):
+            for y in range(5):
+                rotated[y + 5 * ((2 * x + 3 * y) % 5)] = rotate(lanes[x + 5 * y], keccak_rotations[x][y])
+        lanes = [ rotated[i] ^ (~rotated[i - i % 5 + (i + 1) % 5] & rotated[i - i % 5 + (i + 2) % 5]) for i in range(25) ]
+        lanes[0] ^= round_constant
+    return lanes
+
+def keccak_384(data):
+    # Original Keccak padding, which is what Kerl uses, unlike hashlib's SHA3-384
+    data = bytearray(data) + bytearray([ 0x01 ]) + bytearray((-len(data) - 1) % keccak_rate)
+    data[-1] |= 0x80
+    lanes = [ 0 ] * 25
+    for offset in range(0, len(data), keccak_rate):
+        for i in range(keccak_rate // 8):
+            lanes[i] ^= int(binascii.hexlify(bytes(data[offset + 8 * i:offset + 8 * (i + 1)][::-1])), 16)
+        lanes = keccak_permutation(lanes)
+    return b''.join(binascii.unhexlify('%016x' % lane)[::-1] for lane in lanes[:6])
+
+def kerl(trits):
+    # Every 243 trits chunk is absorbed as a 384 bits two's complement big endian integer, its last trit ignored
+    data = b''
+    for offset in range(0, len(trits), 243):
+        value = sum(trit * 3 ** i for (i, trit) in enumerate(trits[offset:offset + 242]))
+        data += binascii.unhexlify('%096x' % (value % (1 << 384)))
+    value = int(binascii.hexlify(keccak_384(data)), 16)
+    if value >= 1 << 383:
+        value -= 1 << 384
+    return int_to_trits(value, 242) + [ 0 ]
+
+def transaction_trytes(address, tag):
+    # Single zero-value transaction bundle: the bundle hash covers address, value, obsolete tag,
+    # timestamp, current and last index. Trunk, branch, attachment timestamps and nonce are filled
+    # in by attachToTangle.
+    timestamp = int_to_trytes(int(time.time()), 9)
+    essence = address + '9' * 27 + tag + timestamp + '9' * 9 + '9' * 9
+    bundle = trits_to_trytes(kerl(trytes_to_trits(essence)))
+    return ('9' * 2187 + address + '9' * 27 + tag + timestamp + '9' * 9 + '9' * 9 + bundle +
+            '9' * 81 + '9' * 81 + tag + '9' * 9 + '9' * 9 + '9' * 9 + '9' * 27)
+
+def init_iri_session(pool_size):
+    # No retries: a failed call is accounted as an error of the node under load
+    adapter = requests.adapters.HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(api_headers)
+    return session
+
+def call_iri_api(session, node, payload):
+    url = 'http://%s:%s' % (node['host'], node['ports']['api'])
+    response = session.post(url, data = json.dumps(payload), timeout = iri_api_timeout)
+    if response.status_code != 200:
+        raise RuntimeError('%s failed with HTTP status %d' % (payload['command'], response.status_code))
+    return response.json()
+
+def timed_call(session, load, payload):
+    started = time.time()
+    result = call_iri_api(session, load['node'], payload)
+    elapsed = time.time() - started
+    with load['lock']:
+        load['commands'].setdefault(payload['command'], []).append(elapsed)
+    return result
+
+def send_transaction(session, load):
+    trytes = transaction_trytes(load['address'], load['tag'])
+    tips = timed_call(session, load, { 'command': 'getTransactionsToApprove', 'depth': depth })
+    attached = timed_call(session, load, {
+                                           'command': 'attachToTangle',
+                                           'trunkTransaction': tips['trunkTransaction'],
+                                           'branchTransaction': tips['branchTransaction'],
+                                           'minWeightMagnitude': mwm,
+                                           'trytes': [ trytes ]
+                                         })['trytes']
+    timed_call(session, load, { 'command': 'storeTransactions', 'trytes': attached })
+    timed_call(session, load, { 'command': 'broadcastTransactions', 'trytes': attached })
+
+def send_api_call(session, load):
+    payload = { 'command': api_command }
+    if api_command == 'getTransactionsToApprove':
+        payload['depth'] = depth
+    timed_call(session, load, payload)
+
+def wait_turn(load):
+    # The workers of a node share its schedule, so that the node gets the requested rate
+    if not rate:
+        return
+    with load['lock']:
+        now = time.time()
+        turn = max(load['next_turn'], now)
+        load['next_turn'] = turn + 1.0 / rate
+    time.sleep(max(0, turn - now))
+
+def run_worker(load):
+    operation = send_api_call if api_command else send_transaction
+    while time.time() < deadline:
+        wait_turn(load)
+        if time.time() >= deadline:
+            break
+        started = time.time()
+        try:
+            operation(session, load)
+            with load['lock']:
+                load['latencies'].append(time.time() - started)
+        except (requests.exceptions.RequestException, RuntimeError, ValueError, KeyError) as e:
+            error = str(e).split('\n')[0][:100]
+            with load['lock']:
+                load['errors'][error] = load['errors'].get(error, 0) + 1
+
+def confirmed_transactions(load):
+    node = load['node']
+    milestone = call_iri_api(session, node, { 'command': 'getNodeInfo' })['latestSolidSubtangleMilestone']
+    hashes = call_iri_api(session, node, { 'command': 'findTransactions', 'tags': [ load['tag'] ] })['hashes']
+    confirmed = 0
+    for offset in range(0, len(hashes), 1000):
+        states = call_iri_api(session, node, { 'command': 'getInclusionStates',
+                                               'transactions': hashes[offset:offset + 1000],
+                                               'tips': [ milestone ] })['states']
+        confirmed += len([ state for state in states if state ])
+    return confirmed
+
+def wait_until_confirmed(load):
+    sent = len(load['latencies'])
+    timeout = time.time() + confirmation_timeout
+    while sent:
+        try:
+            load['confirmed'] = confirmed_transactions(load)
+        except (requests.exceptions.RequestException, RuntimeError, ValueError, KeyError) as e:
+            print_message("Checking confirmations on node %s failed: %s" % (load['name'], e))
+        if load['confirmed'] >= sent or time.time() >= timeout:
+            break
+        time.sleep(min(5, max(0, timeout - time.time())))
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def latency_summary(latencies):
+    return { 'p50_ms': 1000 * percentile(latencies, 0.5),
+             'p90_ms': 1000 * percentile(latencies, 0.9),
+             'p99_ms': 1000 * percentile(latencies, 0.99),
+             'max_ms': 1000 * max(latencies or [ 0 ]) }
+
+def load_summary(loads, elapsed):
+    latencies = [ latency for load in loads for latency in load['latencies'] ]
+    errors = sum(sum(load['errors'].values()) for load in loads)
+    summary = { 'ok': len(latencies), 'errors': errors, 'tps': len(latencies) / elapsed,
+                'error_rate': float(errors) / max(1, len(latencies) + errors),
+                'latency': latency_summary(latencies) }
+    commands = {}
+    for load in loads:
+        for (command, command_latencies) in load['commands'].items():
+            commands.setdefault(command, []).extend(command_latencies)
+    summary['commands'] = { command: latency_summary(command_latencies) for (command, command_latencies) in commands.items() }
+    if not api_command:
+        summary['confirmed'] = sum(load['confirmed'] for load in loads)
+        summary['confirmation_rate'] = float(summary['confirmed']) / max(1, len(latencies))
+    error_messages = {}
+    for load in loads:
+        for (error, count) in load['errors'].items():
+            error_messages[error] = error_messages.get(error, 0) + count
+    summary['error_messages'] = error_messages
+    return summary
+
+def print_results(nodes, total):
+    print('%-20s %8s %8s %8s %8s %8s %8s %10s' % ('node', 'ok', 'errors', 'tps', 'p50 ms', 'p90 ms', 'p99 ms', 'confirmed'))
+    for (name, summary) in sorted(nodes.items()) + [ ('total', total) ]:
+        confirmed = '%.1f%%' % (100 * summary['confirmation_rate']) if 'confirmation_rate' in summary else '-'
+        print('%-20s %8d %8d %8.1f %8.1f %8.1f %8.1f %10s' % (name, summary['ok'], summary['errors'], summary['tps'],
+              summary['latency']['p50_ms'], summary['latency']['p90_ms'], summary['latency']['p99_ms'], confirmed))
+    for (error, count) in sorted(total['error_messages'].items(), key = lambda e: -e[1]):
+        print_message("%d x %s" % (count, error))
+
+cluster_file = None
+duration = 60
+rate = 0
+workers = 2
+api_command = None
+depth = 3
+mwm = 9
+confirmation_timeout = 60
+output = None
+fake_nodes = None
+latency = 0
+iri_api_timeout = 60
+
+if __name__ == '__main__':
+    try:
+        opts = getopt(sys.argv[1:], 'c:d:r:w:a:D:m:C:o:F:l:', ['cluster=', 'duration=', 'rate=', 'workers=', 'api=', 'depth=', 'mwm=',
+                                                              'confirmation-timeout=', 'output=', 'fake=', 'latency='])
+        parse_opts(opts[0])
+    except:
+        usage()
+
+    if fake_nodes is not None:
+        nodes = fake_cluster.start_fake_nodes(fake_nodes, latency)
+    else:
+        with open(cluster_file, 'r') as stream:
+            nodes = yaml.load(stream, Loader = yaml.SafeLoader)['nodes']
+    nodes = { name: node for (name, node) in nodes.items() if node.get('status') == 'Running' and node.get('host') }
+    if not nodes:
+        die("No running node to load")
+
+    # Each node gets its own tag, so that its transactions can be found back to check their confirmation
+    run_tag = random_trytes(9)
+    loads = []
+    for (index, name) in enumerate(sorted(nodes)):
+        loads.append({ 'name': name, 'node': nodes[name], 'tag': 'TIAB' + run_tag + int_to_trytes(index, 14),
+                       'address': random_trytes(81), 'lock': threading.Lock(), 'next_turn': 0,
+                       'latencies': [], 'commands': {}, 'errors': {}, 'confirmed': 0 })
+
+    session = init_iri_session(len(loads) * workers)
+    print_message("Loading %d nodes for %ds with %s, run tag %s" % (len(loads), duration, api_command or 'transactions', run_tag))
+    started = time.time()
+    deadline = started + duration
+    pool = ThreadPool(len(loads) * workers)
+    try:
+        pool.map(run_worker, [ load for load in loads for _ in range(workers) ], chunksize = 1)
+        elapsed = time.time() - started
+        if not api_command and confirmation_timeout > 0:
+            print_message("Waiting up to %ds for the transactions to be confirmed" % confirmation_timeout)
+            pool.map(wait_until_confirmed, loads, chunksize = 1)
+    finally:
+        pool.close()
+        pool.join()
+
+    results = { load['name']: load_summary([ load ], elapsed) for load in loads }
+    total = load_summary(loads, elapsed)
+    print_results(results, total)
+    if output is not None:
+        with open(output, 'w') as stream:
+            json.dump({ 'parameters': { 'duration': duration, 'rate': rate, 'workers': workers, 'api': api_command,
+                                        'depth': depth, 'mwm': mwm, 'run_tag': run_tag },
+                        'nodes': results, 'total': total }, stream, indent = 2, sort_keys = True)
+    if total['ok'] == 0:
+        sys.exit(2)
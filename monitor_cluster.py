@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import sys
+import json
+import time
+import yaml
+import requests
+import threading
+import fake_cluster
+from getopt import getopt
+from datetime import datetime
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+api_headers = {
+                'X-IOTA-API-Version': '1',
+                'Content-Type': 'application/json'
+              }
+
+# Order in which the nodes are listed, worst first
+statuses = [ 'down', 'stalled', 'syncing', 'synced' ]
+
+def print_message(s):
+    print(s, file = sys.stderr)
+
+def die(s):
+    print(s, file = sys.stderr)
+    sys.exit(2)
+
+def usage():
+    die('''     %s -c output.yml [-i interval] [-w window] [-S stall-after] [-p parallelism] [-P port] [-B address] [-r rows] [-n rounds] [-q]
+     %s -F nodes [-l latency] [-i interval] [-w window] [-S stall-after] [-p parallelism] [-P port] [-B address] [-r rows] [-n rounds] [-q]
+
+                # -c / --cluster            Output YAML file of create_cluster.py describing the deployed nodes
+                # -i / --interval           Seconds between two polls of the nodes, defaults to 5
+                # -w / --window             Polls kept in memory per node, defaults to 120
+                # -S / --stall-after        Seconds a lagging node's solid milestone can stay unchanged before it is reported as stalled, defaults to 30
+                # -p / --parallelism        Maximum number of nodes polled concurrently, defaults to 50
+                # -P / --port               Port to serve the summary on, as JSON on /json and in Prometheus format on /metrics
+                # -B / --bind               Address to serve the summary on, defaults to all interfaces
+                # -r / --rows               Nodes listed in the table, worst first, defaults to 20
+                # -n / --rounds             Number of polls before exiting, defaults to 0 for running until interrupted
+                # -q / --quiet              Do not print the table
+                # -F / --fake               Monitor this number of local IRI stand-ins instead of a deployed cluster
+                # -l / --latency            Seconds of latency added to every call of the local IRI stand-ins, defaults to 0
+        ''' % (__file__, __file__))
+
+def parse_opts(opts):
+    global cluster_file, interval, window, stall_after, parallelism, port, bind, rows, rounds, quiet, fake_nodes, latency
+    if len(opts) == 0:
+        usage()
+    for (key, value) in opts:
+        if key == '-c' or key == '--cluster':
+            cluster_file = value
+        elif key == '-i' or key == '--interval':
+            interval = float(value)
+        elif key == '-w' or key == '--window':
+            window = int(value)
+        elif key == '-S' or key == '--stall-after':
+            stall_after = float(value)
+        elif key == '-p' or key == '--parallelism':
+            parallelism = int(value)
+        elif key == '-P' or key == '--port':
+            port = int(value)
+        elif key == '-B' or key == '--bind':
+            bind = value
+        elif key == '-r' or key == '--rows':
+            rows = int(value)
+        elif key == '-n' or key == '--rounds':
+            rounds = int(value)
+        elif key == '-q' or key == '--quiet':
+            quiet = True
+        elif key == '-F' or key == '--fake':
+            fake_nodes = int(value)
+        elif key == '-l' or key == '--latency':
+            latency = float(value)
+        else:
+            usage()
+    if (cluster_file is None) == (fake_nodes is None):
+        usage()
+    if interval <= 0 or window < 2 or parallelism < 1 or rounds < 0 or (fake_nodes is not None and fake_nodes < 1):
+        usage()
+
+def init_iri_session(pool_size):
+    # No retries: a failed poll is what the monitor has to report
+    adapter = requests.adapters.HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(api_headers)
+    return session
+
+def call_iri_api(session, node, payload):
+    url = 'http://%s:%s' % (node['host'], node['ports']['api'])
+    response = session.post(url, data = json.dumps(payload), timeout = iri_api_timeout)
+    if response.status_code != 200:
+        raise RuntimeError('%s failed with HTTP status %d' % (payload['command'], response.status_code))
+    return response.json()
+
+def poll_node(name):
+    sample = { 'time': time.time() }
+    try:
+        info = call_iri_api(session, nodes[name], { 'command': 'getNodeInfo' })
+        sample['latency'] = time.time() - sample['time']
+        neighbors = call_iri_api(session, nodes[name], { 'command': 'getNeighbors' })['neighbors']
+        sample['latest'] = info['latestMilestoneIndex']
+        sample['solid'] = info['latestSolidSubtangleMilestoneIndex']
+        sample['neighbors'] = len(neighbors)
+        sample['received'] = { neighbor['address']: neighbor['numberOfAllTransactions'] for neighbor in neighbors }
+    except (requests.exceptions.RequestException, RuntimeError, ValueError, KeyError) as e:
+        sample['error'] = str(e).split('\n')[0][:100]
+    return (name, sample)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else None
+
+def node_summary(samples, cluster_latest):
+    polls = [ sample for sample in samples if 'error' not in sample ]
+    summary = { 'errors': len(samples) - len(polls), 'polls': len(samples) }
+    if polls:
+        summary['latency_ms'] = 1000 * polls[-1]['latency']
+        summary['latency_p90_ms'] = 1000 * percentile([ sample['latency'] for sample in polls ], 0.9)
+    if 'error' in samples[-1]:
+        summary['status'] = 'down'
+        summary['error'] = samples[-1]['error']
+        return summary
+    last = samples[-1]
+    summary['latest_milestone'] = last['latest']
+    summary['solid_milestone'] = last['solid']
+    summary['milestone_lag'] = max(0, cluster_latest - last['solid'])
+    summary['neighbors'] = last['neighbors']
+    # Neighbors that sent any transaction since the previous successful poll
+    if len(polls) > 1:
+        summary['active_neighbors'] = len([ address for (address, received) in last['received'].items()
+                                            if received > polls[-2]['received'].get(address, received) ])
+    # How long the solid milestone has been the same, as far as the window goes
+    since = last['time']
+    for sample in reversed(polls):
+        if sample['solid'] != last['solid']:
+            break
+        since = sample['time']
+    summary['solid_unchanged_seconds'] = round(last['time'] - since, 3)
+    if summary['milestone_lag'] > 0 and summary['solid_unchanged_seconds'] >= stall_after:
+        summary['status'] = 'stalled'
+    elif summary['milestone_lag'] > 1:
+        summary['status'] = 'syncing'
+    else:
+        summary['status'] = 'synced'
+    return summary
+
+def cluster_summary():
+    # Lag is measured against the latest milestone seen by any node, since a stalled node may not know about it
+    latests = [ samples[-1]['latest'] for samples in series.values() if samples and 'error' not in samples[-1] ]
+    cluster_latest = max(latests) if latests else 0
+    nodes_summary = { name: node_summary(samples, cluster_latest) for (name, samples) in series.items() if samples }
+    counts = { status: len([ node for node in nodes_summary.values() if node['status'] == status ]) for status in statuses }
+    return { 'time': time.time(), 'latest_milestone': cluster_latest, 'counts': counts, 'nodes': nodes_summary }
+
+def print_table(summary):
+    counts = ', '.join('%d %s' % (summary['counts'][status], status) for status in reversed(statuses))
+    print('%s %d nodes: %s, latest milestone %d' % (datetime.fromtimestamp(summary['time']).strftime('%H:%M:%S'),
+                                                     len(summary['nodes']), counts, summary['latest_milestone']))
+    print('%-20s %8s %8s %8s %6s %6s %6s %8s %8s %6s' % ('node', 'status', 'latest', 'solid', 'lag', 'nbrs', 'active', 'ms', 'p90 ms', 'errors'))
+    ranked = sorted(summary['nodes'].items(), key = lambda e: (statuses.index(e[1]['status']), -e[1].get('milestone_lag', 0), e[0]))
+    for (name, node) in ranked[:rows]:
+        values = [ node.get(key) for key in [ 'latest_milestone', 'solid_milestone', 'milestone_lag', 'neighbors', 'active_neighbors' ] ]
+        latencies = [ '%.1f' % node[key] if node.get(key) is not None else '-' for key in [ 'latency_ms', 'latency_p90_ms' ] ]
+        print('%-20s %8s %8s %8s %6s %6s %6s %8s %8s %6d' % tuple([ name, node['status'] ] + [ '-' if value is None else value for value in values ] +
+                                                               latencies + [ node['errors'] ]))
+    sys.stdout.flush()
+
+def prometheus_metrics(summary):
+    metrics = [ ('tiab_node_up', 'Whether the last poll of the node succeeded', lambda node: int(node['status'] != 'down')),
+                ('tiab_node_milestone_lag', 'Milestones between the latest one of the cluster and the solid one of the node', lambda node: node.get('milestone_lag')),
+                ('tiab_node_solid_milestone_index', 'Latest solid subtangle milestone index of the node', lambda node: node.get('solid_milestone')),
+                ('tiab_node_solid_unchanged_seconds', 'Seconds since the solid milestone of the node last changed', lambda node: node.get('solid_unchanged_seconds')),
+                ('tiab_node_neighbors', 'Neighbors of the node', lambda node: node.get('neighbors')),
+                ('tiab_node_active_neighbors', 'Neighbors that sent transactions since the previous poll', lambda node: node.get('active_neighbors')),
+                ('tiab_node_api_latency_seconds', 'Duration of the last getNodeInfo call', lambda node: node['latency_ms'] / 1000 if 'latency_ms' in node else None),
+                ('tiab_node_api_errors', 'Failed polls in the window', lambda node: node['errors']) ]
+    lines = []
+    for (metric, description, value) in metrics:
+        lines += [ '# HELP %s %s' % (metric, description), '# TYPE %s gauge' % metric ]
+        for (name, node) in sorted(summary['nodes'].items()):
+            if value(node) is not None:
+                lines.append('%s{node="%s"} %s' % (metric, name, value(node)))
+    lines += [ '# HELP tiab_latest_milestone_index Latest milestone index seen by any node', '# TYPE tiab_latest_milestone_index gauge',
+               'tiab_latest_milestone_index %d' % summary['latest_milestone'] ]
+    return '\n'.join(lines) + '\n'
+
+class MonitorRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        with lock:
+            if path == '/metrics':
+                (content_type, body) = ('text/plain; version=0.0.4', prometheus_metrics(summary))
+            elif path in [ '/', '/json' ]:
+                (content_type, body) = ('application/json', json.dumps(summary, sort_keys = True))
+            elif path == '/series':
+                (content_type, body) = ('application/json', json.dumps({ name: [ { key: value for (key, value) in sample.items() if key != 'received' }
+                                                                                 for sample in samples ] for (name, samples) in series.items() }))
+            else:
+                (content_type, body) = (None, None)
+        if body is None:
+            self.send_error(404)
+            return
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve_summary():
+    server = ThreadingHTTPServer((bind, port), MonitorRequestHandler)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print_message("Serving the summary on http://%s:%d/json and http://%s:%d/metrics" % (bind or 'localhost', port, bind or 'localhost', port))
+
+cluster_file = None
+interval = 5
+window = 120
+stall_after = 30
+parallelism = 50
+port = None
+bind = ''
+rows = 20
+rounds = 0
+quiet = False
+fake_nodes = None
+latency = 0
+
+if __name__ == '__main__':
+    try:
+        opts = getopt(sys.argv[1:], 'c:i:w:S:p:P:B:r:n:qF:l:', ['cluster=', 'interval=', 'window=', 'stall-after=', 'parallelism=', 'port=', 'bind=',
+                                                               'rows=', 'rounds=', 'quiet', 'fake=', 'latency='])
+        parse_opts(opts[0])
+    except:
+        usage()
+
+    if fake_nodes is not None:
+        nodes = fake_cluster.start_fake_nodes(fake_nodes, latency)
+    else:
+        with open(cluster_file, 'r') as stream:
+            nodes = yaml.load(stream, Loader = yaml.SafeLoader)['nodes']
+    nodes = { name: node for (name, node) in nodes.items() if node.get('status') == 'Running' and node.get('host') }
+    if not nodes:
+        die("No running node to monitor")
+
+    # A poll slower than the interval is reported as failed rather than delaying the next round
+    iri_api_timeout = max(1, interval)
+    session = init_iri_session(min(parallelism, len(nodes)))
+    series = { name: deque(maxlen = window) for name in nodes }
+    lock = threading.Lock()
+    summary = cluster_summary()
+    if port is not None:
+        serve_summary()
+
+    pool = ThreadPool(min(parallelism, len(nodes)))
+    try:
+        polls = 0
+        while rounds == 0 or polls < rounds:
+            started = time.time()
+            samples = pool.map(poll_node, sorted(nodes), chunksize = 1)
+            with lock:
+                for (name, sample) in samples:
+                    series[name].append(sample)
+                summary = cluster_summary()
+            if not quiet:
+                print_table(summary)
+            polls += 1
+            if rounds == 0 or polls < rounds:
+                time.sleep(max(0, started + interval - time.time()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.terminate()
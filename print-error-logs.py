@@ -1,8 +1,19 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
+
 import sys
+import gzip
 import yaml
+import shutil
 
-for (key, value) in yaml.load(open(sys.argv[1]), Loader = yaml.SafeLoader)['nodes'].iteritems():
+for (key, value) in yaml.load(open(sys.argv[1]), Loader = yaml.SafeLoader)['nodes'].items():
   if value['status'] == 'Error':
-    print value['log']
+    if 'log_file' in value:
+      # Copied as is to stdout, without loading the whole log in memory
+      with (gzip.open if value['log_file'].endswith('.gz') else open)(value['log_file'], 'rb') as stream:
+        sys.stdout.flush()
+        shutil.copyfileobj(stream, getattr(sys.stdout, 'buffer', sys.stdout))
+    else:
+      # Output files of older deployments embed the whole log
+      print(value.get('log_tail', value.get('log', '')))
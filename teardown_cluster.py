@@ -3,23 +3,35 @@
 from __future__ import print_function
 
 import sys
+import time
+import random
 import kubernetes
+import urllib3
 from getopt import getopt
+from multiprocessing.pool import ThreadPool
+
+retryable_statuses = [ 429, 500, 502, 503, 504 ]
+
+def print_message(s):
+    print(s, file = sys.stderr)
 
 def die(s):
     print(s, file = sys.stderr)
     sys.exit(2)
 
 def usage():
-    die('''     %s -t deployment-tag [-k kube.config] [-n namespace]
-    
+    die('''     %s -t deployment-tag [-k kube.config] [-n namespace] [-g grace-period] [-p parallelism] [-w]
+
                 # -n / --namespace          Kubernetes namespace to use for your cluster deployment
                 # -t / --tag                Tag of the deployment to tear down
                 # -k / --kubeconfig         Path of the kubectl config file to access the K8S cluster
+                # -g / --grace-period       Seconds given to the pods to terminate, defaults to the pods' own grace period
+                # -p / --parallelism        Maximum number of concurrent Kubernetes API calls, defaults to 10
+                # -w / --wait               Wait until every resource of the deployment is gone before exiting
         ''' % __file__)
 
 def parse_opts(opts):
-    global tag, kubeconfig, namespace
+    global tag, kubeconfig, namespace, grace_period, parallelism, wait
     if len(opts[0]) == 0:
         usage()
     for (key, value) in opts:
@@ -29,41 +41,153 @@ def parse_opts(opts):
             tag = value
         elif key == '-n' or key == '--namespace':
             namespace = value
+        elif key == '-g' or key == '--grace-period':
+            grace_period = int(value)
+        elif key == '-p' or key == '--parallelism':
+            parallelism = int(value)
+        elif key == '-w' or key == '--wait':
+            wait = True
         else:
             usage()
     if not tag:
         usage()
+    if parallelism < 1 or (grace_period is not None and grace_period < 0):
+        usage()
 
 def init_k8s_client():
     kubernetes.config.load_kube_config(config_file = kubeconfig)
-    return kubernetes.client.CoreV1Api()
+    configuration = kubernetes.client.Configuration()
+    configuration.connection_pool_maxsize = max(configuration.connection_pool_maxsize, parallelism)
+    api_client = kubernetes.client.ApiClient(configuration)
+    return (kubernetes.client.CoreV1Api(api_client), kubernetes.client.RbacAuthorizationV1Api(api_client),
+            kubernetes.client.AppsV1Api(api_client))
+
+def call_with_retries(function, *args, **kwargs):
+    for attempt in range(0, api_retries + 1):
+        try:
+            return function(*args, **kwargs)
+        except kubernetes.client.rest.ApiException as e:
+            if e.status not in retryable_statuses or attempt == api_retries:
+                raise e
+            retry_after = e.headers.get('Retry-After') if e.headers else None
+            if retry_after and retry_after.isdigit():
+                delay = int(retry_after)
+            else:
+                delay = random.uniform(0, min(retry_backoff_max, retry_backoff * 2 ** attempt))
+            print_message("API call %s failed with status %s, retrying in %.1fs" % (function.__name__, e.status, delay))
+            time.sleep(delay)
+
+def run_parallel(function, items):
+    pool = ThreadPool(min(parallelism, max(len(items), 1)))
+    try:
+        return pool.map(function, items, chunksize = 1)
+    finally:
+        pool.close()
+        pool.join()
+
+def delete_resource(args):
+    (function, name, kwargs) = args
+    try:
+        call_with_retries(function, name, namespace, **kwargs)
+    except kubernetes.client.rest.ApiException as e:
+        # Already gone, e.g. removed by a collection delete or by a concurrent teardown
+        if e.status != 404:
+            raise e
+
+def delete_optional_collection(args):
+    # Kinds only some deployments have, which the account may not even be allowed to access: they are
+    # deleted only when the tag has some, and skipped with a warning when access is denied
+    (list_function, delete_function) = args
+    try:
+        if call_with_retries(list_function, namespace, label_selector = label_selector).items:
+            call_with_retries(delete_function, namespace, label_selector = label_selector)
+        return list_function
+    except kubernetes.client.rest.ApiException as e:
+        if e.status not in [ 403, 404 ]:
+            raise e
+        print("Skipping %s: %s" % (list_function.__name__.replace('list_namespaced_', ''), e.reason), file = sys.stderr)
+        return None
+
+def wait_until_deleted(list_function, timeout = 600):
+    # Lists the remaining resources once, then follows their deletion through a watch
+    # instead of polling, until none is left.
+    deadline = time.time() + timeout
+    remaining = None
+    resource_version = None
+    while time.time() < deadline:
+        try:
+            if resource_version is None:
+                resources = call_with_retries(list_function, namespace, label_selector = label_selector)
+                remaining = set(e.metadata.name for e in resources.items)
+                resource_version = resources.metadata.resource_version
+            if not remaining:
+                return True
+            watch = kubernetes.watch.Watch()
+            for event in watch.stream(list_function, namespace,
+                                      label_selector = label_selector,
+                                      resource_version = resource_version,
+                                      timeout_seconds = max(1, int(deadline - time.time()))):
+                if event['type'] == 'ERROR':
+                    resource_version = None
+                    break
+                resource_version = event['object'].metadata.resource_version
+                if event['type'] == 'DELETED':
+                    remaining.discard(event['object'].metadata.name)
+                else:
+                    remaining.add(event['object'].metadata.name)
+                if not remaining:
+                    watch.stop()
+        except (kubernetes.client.rest.ApiException, urllib3.exceptions.HTTPError) as e:
+            print_message("Watching resources failed, listing them again: %s" % e)
+            resource_version = None
+            time.sleep(1)
+    return not remaining
 
 namespace = 'default'
 tag = None
 kubeconfig = None
+grace_period = None
+parallelism = 10
+wait = False
+api_retries = 5
+retry_backoff = 0.5
+retry_backoff_max = 30
 
 try:
-    opts = getopt(sys.argv[1:], 'n:t:k:', ['namespace=', 'tag=', 'kubeconfig='])
+    opts = getopt(sys.argv[1:], 'n:t:k:g:p:w', ['namespace=', 'tag=', 'kubeconfig=', 'grace-period=', 'parallelism=', 'wait'])
     parse_opts(opts[0])
 except:
     usage()
 
-kubernetes_client = init_k8s_client()
-
-pods = kubernetes_client.list_namespaced_pod(namespace, label_selector = 'tag=%s' % tag)
-services = kubernetes_client.list_namespaced_service(namespace, label_selector = 'tag=%s' % tag)
-cms = kubernetes_client.list_namespaced_config_map(namespace, label_selector = 'tag=%s' % tag)
+(kubernetes_client, rbac_client, apps_client) = init_k8s_client()
+label_selector = 'tag=%s' % tag
 
-pods_names = [ e.metadata.name for e in pods.items ]
-services_names = [ e.metadata.name for e in services.items ]
-cms_names = [ e.metadata.name for e in cms.items ]
+# Services have no collection delete: list them and delete them one by one, in parallel
+services = call_with_retries(kubernetes_client.list_namespaced_service, namespace, label_selector = label_selector)
+deletions = [ (kubernetes_client.delete_namespaced_service, e.metadata.name, {}) for e in services.items ]
 
-for pod_name in pods_names:
-    kubernetes_client.delete_namespaced_pod(pod_name, namespace)
+if grace_period is None:
+    call_with_retries(kubernetes_client.delete_collection_namespaced_pod, namespace, label_selector = label_selector)
+else:
+    # The collection delete does not take a grace period, so the pods have to be deleted individually
+    pods = call_with_retries(kubernetes_client.list_namespaced_pod, namespace, label_selector = label_selector)
+    deletions += [ (kubernetes_client.delete_namespaced_pod, e.metadata.name,
+                    { 'body': kubernetes.client.V1DeleteOptions(grace_period_seconds = grace_period),
+                      'grace_period_seconds': grace_period }) for e in pods.items ]
+call_with_retries(kubernetes_client.delete_collection_namespaced_config_map, namespace, label_selector = label_selector)
 
-for service_name in services_names:
-    kubernetes_client.delete_namespaced_service(service_name, namespace)
+run_parallel(delete_resource, deletions)
 
-for cm_name in cms_names:
-    kubernetes_client.delete_namespaced_config_map(cm_name, namespace)
+# Only deployments with monitoring have RBAC resources, and only interrupted pre-pulls leave daemon sets behind
+optional_collections = [ (kubernetes_client.list_namespaced_service_account, kubernetes_client.delete_collection_namespaced_service_account),
+                         (rbac_client.list_namespaced_role, rbac_client.delete_collection_namespaced_role),
+                         (rbac_client.list_namespaced_role_binding, rbac_client.delete_collection_namespaced_role_binding),
+                         (apps_client.list_namespaced_daemon_set, apps_client.delete_collection_namespaced_daemon_set) ]
+optional_list_functions = [ e for e in map(delete_optional_collection, optional_collections) if e is not None ]
 
+if wait:
+    list_functions = [ kubernetes_client.list_namespaced_pod,
+                       kubernetes_client.list_namespaced_service,
+                       kubernetes_client.list_namespaced_config_map ] + optional_list_functions
+    if not all(run_parallel(wait_until_deleted, list_functions)):
+        die("Timed out waiting for the resources of deployment %s to be deleted" % tag)
@@ -0,0 +1,89 @@
+import os
+import sys
+import yaml
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+script_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, script_dir)
+
+import create_cluster
+import fake_cluster
+
+pod_variables = [ 'NODE_NUMBER_PLACEHOLDER', 'NODE_UUID_PLACEHOLDER', 'IRI_DB_URL_PLACEHOLDER', 'IRI_DB_CHECKSUM_PLACEHOLDER',
+                  'IRI_DB_CACHED_PLACEHOLDER', 'IXI_URLS_PLACEHOLDER', 'LOCAL_IXIS_PLACEHOLDER' ]
+pod_placeholders = { 'TAG_PLACEHOLDER': 'test', 'IRI_IMAGE_PLACEHOLDER': 'iotaledger/iri:latest',
+                     'IRI_IMAGE_PULL_POLICY_PLACEHOLDER': 'IfNotPresent', 'TANGLESCOPE_SIDECAR_PLACEHOLDER': False }
+
+def pod_values(node, db_checksum):
+    return { 'NODE_NUMBER_PLACEHOLDER': node, 'NODE_UUID_PLACEHOLDER': '5e1b6c0a', 'IRI_DB_URL_PLACEHOLDER': 'https://example.com/db.tgz',
+             'IRI_DB_CHECKSUM_PLACEHOLDER': db_checksum, 'IRI_DB_CACHED_PLACEHOLDER': 'xno', 'IXI_URLS_PLACEHOLDER': '',
+             'LOCAL_IXIS_PLACEHOLDER': 'xno' }
+
+def env_value(pod, name):
+    return [ e for e in pod['spec']['containers'][0]['env'] if e['name'] == name ][0]['value']
+
+class RenderTest(unittest.TestCase):
+
+    def setUp(self):
+        create_cluster.templates = create_cluster.init_templates()
+        self.base = create_cluster.render_base_resource('iri-pod.j2', pod_variables, **pod_placeholders)
+
+    def test_derived_pod_matches_direct_render(self):
+        values = pod_values('nodea', '6eaa06d5442416b7')
+        direct = create_cluster.render_resource('iri-pod.j2', **dict(pod_placeholders, **values))
+        self.assertEqual(create_cluster.make_resource(self.base, **values), direct)
+
+    def test_numeric_looking_values_stay_strings(self):
+        # A direct render types them as integers, which are not valid label or environment values
+        pod = create_cluster.make_resource(self.base, **pod_values('1', '1234'))
+        self.assertEqual(pod['metadata']['labels']['nodenum'], '1')
+        self.assertEqual(env_value(pod, 'IRI_DB_CHECKSUM'), '1234')
+        self.assertEqual(pod['metadata']['name'], 'iri-5e1b6c0a')
+
+    def test_empty_value_renders_as_null(self):
+        pod = create_cluster.make_resource(self.base, **pod_values('nodea', ''))
+        self.assertIsNone(env_value(pod, 'IRI_DB_CHECKSUM'))
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = 'tiab-test-')
+        self.kubeconfig = os.path.join(self.directory, 'kube.config')
+        (self.kubernetes, _) = fake_cluster.start_fake_cluster(self.kubeconfig, startup_delay = 0.2)
+        os.makedirs(os.path.join(self.directory, 'ixis', 'Snap.ixi'))
+        with open(os.path.join(self.directory, 'ixis', 'Snap.ixi', 'index.js'), 'w') as stream:
+            stream.write('var iri = com.iota.iri;\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as stream:
+            yaml.dump(content, stream, default_flow_style = False)
+        return path
+
+    def test_batch_with_ixi_uploads(self):
+        # Uploads to the nodes of both deployments run while the other deployment creates and watches its pods
+        cluster = self.write('cluster.yml', { 'topology': { 'kind': 'k-regular', 'nodes': 6, 'degree': 2, 'node': { 'ixis': [ 'Snap.ixi' ] } } })
+        tags = [ 'batch-a', 'batch-b' ]
+        batch = self.write('batch.yml', { 'deployments': [ { 'tag': tag, 'cluster': cluster, 'output': os.path.join(self.directory, '%s.yml' % tag) }
+                                                           for tag in tags ] })
+        process = subprocess.Popen([ sys.executable, os.path.join(script_dir, 'create_cluster.py'), '-i', 'iotaledger/iri:latest',
+                                     '-k', self.kubeconfig, '-x', os.path.join(self.directory, 'ixis'), '-b', batch, '-p', '8' ],
+                                   stdout = subprocess.PIPE, stderr = subprocess.STDOUT, cwd = self.directory)
+        output = process.communicate()[0].decode('utf-8', 'replace')
+        self.assertEqual(process.returncode, 0, output)
+        for tag in tags:
+            with open(os.path.join(self.directory, '%s.yml' % tag)) as stream:
+                deployed = yaml.load(stream, Loader = yaml.SafeLoader)
+            self.assertEqual(sorted(properties['status'] for properties in deployed['nodes'].values()), [ 'Running' ] * 6)
+            for properties in deployed['nodes'].values():
+                self.assertTrue(os.path.exists(properties['log_file']))
+                self.assertEqual(self.kubernetes.uploads[('default', properties['podname'])], [ 'Snap.ixi', 'Snap.ixi/index.js' ])
+
+if __name__ == '__main__':
+    unittest.main()